@@ -5,13 +5,30 @@
 import os
 
 
+def _Intern(s):
+  # Coordinates repeat heavily across a resolved graph, so share one copy of
+  # each groupId/artifactId string. intern() only accepts byte strings.
+  try:
+    return intern(s)
+  except TypeError:
+    return s
+
+
 class Artifact(object):
   '''
     The possible options are:
     - groupId:artifactId:version
     - groupId:artifactId:packaging:version
     - groupId:artifactId:packaging:classifier:version
+
+    The coordinate is immutable, use Copy() for another version or
+    extension. Only snapshot_version, which is not part of the identity, may
+    be filled in later.
   '''
+  __slots__ = ('_group_id', '_artifact_id', '_version', '_classifier',
+               '_extension', '_snapshot_version', '_base_path', '_key',
+               '_str', '_hash', '_filename', '_name', '_pom')
+
   def __init__(self, group_id, artifact_id, version,
                classifier=None,
                extension=None,
@@ -21,15 +38,75 @@ class Artifact(object):
     if not artifact_id:
       raise ValueError('artifact_id must be set')
     
-    self.group_id = group_id
-    self.artifact_id = artifact_id
-    self.version = version
-    self.snapshot_version = snapshot_version
-    self.classifier = classifier
+    self._group_id = _Intern(group_id)
+    self._artifact_id = _Intern(artifact_id)
+    self._base_path = self._group_id.replace('.', '/') + '/' + \
+        self._artifact_id
+    self._version = version
+    self._snapshot_version = snapshot_version
+    self._classifier = classifier
     if not extension:
-      self.extension = 'jar'
+      self._extension = 'jar'
     else:
-      self.extension = extension
+      self._extension = extension
+    self._key = None
+    self._str = None
+    self._hash = None
+    self._filename = None
+    self._name = None
+    self._pom = None
+
+  @property
+  def group_id(self):
+    return self._group_id
+
+  @property
+  def artifact_id(self):
+    return self._artifact_id
+
+  @property
+  def classifier(self):
+    return self._classifier
+
+  @property
+  def version(self):
+    return self._version
+
+  @property
+  def snapshot_version(self):
+    return self._snapshot_version
+
+  @snapshot_version.setter
+  def snapshot_version(self, value):
+    self._snapshot_version = value
+    self._filename = None
+    self._pom = None
+
+  @property
+  def extension(self):
+    return self._extension
+
+  def Key(self):
+    '''Identity of this artifact regardless of its version.'''
+    if self._key is None:
+      self._key = (self._group_id, self._artifact_id,
+                   self._extension, self._classifier)
+    return self._key
+
+  def Copy(self, version=None, extension=None):
+    '''A copy with |version| or |extension| changed when given. The
+       snapshot version is only kept for the same version.'''
+    snapshot_version = self.snapshot_version
+    if version is None:
+      version = self.version
+    elif version != self.version:
+      snapshot_version = None
+    return Artifact(self.group_id,
+                    self.artifact_id,
+                    version,
+                    classifier=self.classifier,
+                    extension=extension or self.extension,
+                    snapshot_version=snapshot_version)
 
   def GenerateSourcesJarArtifact(self):
     if self.extension != 'jar':
@@ -52,11 +129,13 @@ class Artifact(object):
     return self.version[:self.version.find('SNAPSHOT')]
 
   def Path(self, with_version=True, with_filename=False):
-    path = self.group_id.replace('.', '/') + '/' + self.artifact_id
+    path = self._base_path
     if with_version:
       path = path + '/' + self.version
     if with_filename:
-      path = path + '/' + self._GenerateFilename(True)
+      if self._filename is None:
+        self._filename = self._GenerateFilename(True)
+      path = path + '/' + self._filename
     return path
 
   def _GenerateFilename(self, with_version=False):
@@ -70,7 +149,9 @@ class Artifact(object):
     return filename + '.' + self.extension
 
   def GetFilename(self, filepath=None, detailed=False):
-    filename = self._GenerateFilename()
+    if self._name is None:
+      self._name = self._GenerateFilename()
+    filename = self._name
     if filepath:
       filename = os.path.join(filepath, filename)
     if detailed:
@@ -81,30 +162,52 @@ class Artifact(object):
     return filename
 
   def GetPom(self):
-    v = self.version if not self.IsSnapshot() else self.snapshot_version
-    assert v
-    return self.artifact_id + '-' + v + '.pom'
+    if self._pom is None:
+      v = self.version if not self.IsSnapshot() else self.snapshot_version
+      assert v
+      self._pom = self.artifact_id + '-' + v + '.pom'
+    return self._pom
 
   def ArtifactEquel(self, other):
-    return self.group_id == other.group_id \
-        and self.artifact_id == other.artifact_id \
-        and self.extension == other.extension \
-        and self.classifier == other.classifier
+    return self.Key() == other.Key()
+
+  def __eq__(self, other):
+    if not isinstance(other, Artifact):
+      return NotImplemented
+    return self.Key() == other.Key() and self._version == other._version
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  def __hash__(self):
+    if self._hash is None:
+      self._hash = hash((self.Key(), self._version))
+    return self._hash
+
+  def __repr__(self):
+    return 'Artifact(%s)' % self.__str__()
   
   def __str__(self):
+    if self._str is not None:
+      return self._str
     if self.classifier:
-      return '%s:%s:%s:%s:%s' % (self.group_id,
-                                 self.artifact_id,
-                                 self.extension,
-                                 self.classifier,
-                                 self.version)
-    elif self.extension != 'jar':
-      return '%s:%s:%s:%s' % (self.group_id,
+      s = '%s:%s:%s:%s:%s' % (self.group_id,
                               self.artifact_id,
                               self.extension,
+                              self.classifier,
                               self.version)
+    elif self.extension != 'jar':
+      s = '%s:%s:%s:%s' % (self.group_id,
+                           self.artifact_id,
+                           self.extension,
+                           self.version)
     else:
-      return '%s:%s:%s' % (self.group_id, self.artifact_id, self.version)
+      s = '%s:%s:%s' % (self.group_id, self.artifact_id, self.version)
+    self._str = s
+    return s
 
   def ToGradleCoordinate(self):
     '''
@@ -141,9 +244,9 @@ class Artifact(object):
       t = parts[2]
       c = parts[3]
     arti = Artifact(g, a, v, c, t)
-    if arti.IsSnapshot():
-      # handle snapshot version
-      assert downloader
+    if arti.IsSnapshot() and downloader:
+      # handle snapshot version, without |downloader| it is left to
+      # metadata.ResolveSnapshots.
       import metadata
       meta = metadata.Metadata.Parse(downloader, arti)
       arti.snapshot_version = meta.GetLastversion()
@@ -204,6 +307,25 @@ if __name__ == '__main__':
   assert not arti1.ArtifactEquel(arti3)
   assert not arti2.ArtifactEquel(arti3)
 
+  # Test hash
+  assert arti1 == Artifact.Parse(coordinate1)
+  assert arti1 != Artifact.Parse('junit:junit:4.3')
+  assert arti1.ArtifactEquel(Artifact.Parse('junit:junit:4.3'))
+  assert len(set([arti1, arti2, arti3, Artifact.Parse(coordinate1)])) == 3
+  assert { arti1: 1 }[Artifact.Parse(coordinate1)] == 1
+  arti4 = Artifact.Parse(coordinate1).Copy(version='4.3')
+  assert 'junit:junit:4.3' == str(arti4)
+  assert 'junit/junit/4.3/junit-4.3.jar' == arti4.Path(with_filename=True)
+  assert arti4 == Artifact.Parse('junit:junit:4.3')
+  s = set([arti1])
+  try:
+    arti1.version = '4.3'
+    assert False
+  except AttributeError:
+    pass
+  assert arti1 in s
+  assert 'junit:junit:so:4.2' == str(arti1.Copy(extension='so'))
+
   # Test snapshot
   import downloader
   d = downloader.Downloader(
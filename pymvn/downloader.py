@@ -1,12 +1,34 @@
 # Downloader.
 
+import bisect
+import cStringIO
+import fnmatch
+import httplib
 import os
+import Queue
+import random
+import socket
 import sys
+import threading
+import time
 import posixpath
 import urlparse
 import utils
 
 
+def _ParseChecksum(content):
+  # Checksum files may look like '<md5>' or '<md5>  <filename>'.
+  parts = content.split()
+  return parts[0].lower() if parts else ''
+
+
+class FetchError(Exception):
+  '''Raised by fetchers, |retryable| tells whether trying again may help.'''
+  def __init__(self, message, retryable=False):
+    Exception.__init__(self, message)
+    self.retryable = retryable
+
+
 class Fetcher(object):
   def __init__(self):
     pass
@@ -14,13 +36,104 @@ class Fetcher(object):
   def Fetch(self, url):
     pass
 
+  def LocalPath(self, url):
+    '''Path of |url| when the fetcher reads from a filesystem, or None.'''
+    return None
+
+
+class _Call(object):
+  '''A GET in flight, shared by every caller asking for the same url.'''
+  def __init__(self):
+    self.done = threading.Event()
+    self.content = None
+    self.error = None
+
+
+class LatencyTracker(object):
+  '''Keeps the latest |window| latencies to answer percentile queries.'''
+  def __init__(self, window=200, min_samples=20):
+    self.window = window
+    self.min_samples = min_samples
+    self.samples = []
+    self.ordered = []
+    self.lock = threading.Lock()
+
+  def Add(self, latency):
+    with self.lock:
+      self.samples.append(latency)
+      bisect.insort(self.ordered, latency)
+      if len(self.samples) > self.window:
+        oldest = self.samples.pop(0)
+        del self.ordered[bisect.bisect_left(self.ordered, oldest)]
+
+  def Percentile(self, percentile):
+    with self.lock:
+      if len(self.ordered) < self.min_samples:
+        return None
+      index = int(len(self.ordered) * percentile / 100.0)
+      return self.ordered[min(index, len(self.ordered) - 1)]
+
+
+class LocalRepository(object):
+  '''A local maven repository (e.g. ~/.m2/repository) laid out like the
+     remote one. Metadata there only covers versions seen by this machine, so
+     it is served only when |with_metadata| is set, e.g. while offline.'''
+  def __init__(self, path, with_metadata=False):
+    self.path = path
+    self.with_metadata = with_metadata
+
+  def Find(self, relative_path):
+    path = os.path.join(self.path, *relative_path.split('/'))
+    if posixpath.basename(relative_path).startswith('maven-metadata'):
+      return self._FindMetadata(path)
+    return path if os.path.isfile(path) else None
+
+  def _FindMetadata(self, path):
+    if not self.with_metadata:
+      return None
+    if os.path.isfile(path):
+      return path
+    # Maven stores metadata as maven-metadata-<repository id>.xml locally.
+    dirname, basename = os.path.split(path)
+    if basename != 'maven-metadata.xml' or not os.path.isdir(dirname):
+      return None
+    names = sorted(fnmatch.filter(os.listdir(dirname), 'maven-metadata-*.xml'))
+    if 'maven-metadata-local.xml' in names:
+      return os.path.join(dirname, 'maven-metadata-local.xml')
+    return os.path.join(dirname, names[0]) if names else None
+
 
 class Downloader(object):
-  def __init__(self, fetcher, base=None):
+  def __init__(self, fetcher, base=None, local_repository=None,
+               offline=False):
     self.fetcher = fetcher
     # You can init download by giving the base url,
     # So you can invoke apis passing relative url.
     self.base = base
+    # Optional LocalRepository consulted before |fetcher|, and whether
+    # |fetcher| may be used at all.
+    self.local_repository = local_repository
+    self.offline = offline
+    # Optional metadata.MetadataCache shared by all metadata.xml lookups.
+    self.metadata_cache = None
+    # Optional pom.PomCache sharing parsed poms, e.g. parents and boms.
+    self.pom_cache = None
+    # Set once a version is picked according metadata.xml (snapshots, ranges
+    # and missing versions), a later run may then pick another one.
+    self.used_metadata = False
+    # Retry failed GETs |retries| times, waiting |backoff| * 2^n seconds.
+    self.retries = 3
+    self.backoff = 0.5
+    # A hedged GET sends a second request, to the next of |mirrors| or to
+    # |base| again, once the first is slower than |hedge_percentile| of
+    # recent hedged GETs. 0 disables hedging.
+    self.mirrors = []
+    self.hedge_percentile = 0
+    self.latency = LatencyTracker()
+    self.hedge_count = 0
+    # coalesced GETs in flight by normalized url.
+    self.calls = {}
+    self.lock = threading.Lock()
 
   def _NormalizeURL(self, url):
     if not self.base:
@@ -40,32 +153,197 @@ class Downloader(object):
     #print 'normalized url -- %s' % normalized_url
     return normalized_url
 
-  def Get(self, url, failmsg, func):
+  def FindLocal(self, url):
+    '''Path of |url| in the local repository, or None.'''
+    if not self.local_repository or not self.base:
+      return None
+    base = self._NormalizeURL(self.base).rstrip('/')
     formated_url = self._NormalizeURL(url)
-    response = self.fetcher.Fetch(formated_url, failmsg)
-    return func(response)
+    if not formated_url.startswith(base + '/'):
+      return None
+    return self.local_repository.Find(formated_url[len(base):].lstrip('/'))
+
+  def GetMD5(self, url):
+    '''MD5 of the file at |url| according its .md5 file. Filesystem
+       repositories do not always keep .md5 files, but the file itself is
+       right there to be hashed then.'''
+    md5_url = url + '.md5'
+    local_md5 = self.fetcher.LocalPath(self._NormalizeURL(md5_url))
+    if local_md5 and not os.path.exists(local_md5):
+      local_path = local_md5[:-len('.md5')]
+      if not os.path.exists(local_path):
+        raise FetchError('Failed to find %s' % local_path, False)
+      return utils.MD5File(local_path)
+    return self.Get(md5_url, 'Failed to fetch MD5',
+                    lambda r: _ParseChecksum(r.read()), hedge=True,
+                    coalesce=True)
+
+  def Get(self, url, failmsg, func, hedge=False, coalesce=False):
+    '''GET |url| and return |func|(response). |hedge| and |coalesce| should
+       only be set for small resources like pom.xml and metadata.xml. With
+       |coalesce| concurrent GETs of the same url share one request, each
+       caller applies its |func| to the shared content.'''
+    formated_url = self._NormalizeURL(url)
+    local_path = self.FindLocal(formated_url)
+    if local_path:
+      return func(open(local_path, 'rb'))
+    if self.offline:
+      raise Exception('%s because %s is not in local repository while '
+                      'offline' % (failmsg, formated_url))
+    if coalesce:
+      content = self._CoalescedGet(formated_url, failmsg, hedge)
+      return func(cStringIO.StringIO(content))
+    return self._RemoteGet(formated_url, failmsg, func, hedge)
+
+  def _RemoteGet(self, url, failmsg, func, hedge):
+    # a second read of the same filesystem would not be any faster.
+    if hedge and self.hedge_percentile and not self.fetcher.LocalPath(url):
+      return self._HedgedGet(url, failmsg, func)
+    return self._RetriedGet(url, failmsg, func)
+
+  def _CoalescedGet(self, url, failmsg, hedge):
+    with self.lock:
+      call = self.calls.get(url)
+      leader = call is None
+      if leader:
+        call = _Call()
+        self.calls[url] = call
+    if leader:
+      try:
+        call.content = self._RemoteGet(url, failmsg, lambda r: r.read(), hedge)
+      except Exception, e:
+        call.error = e
+      finally:
+        with self.lock:
+          del self.calls[url]
+        call.done.set()
+    else:
+      call.done.wait()
+    if call.error is not None:
+      raise call.error
+    return call.content
+
+  def _RetriedGet(self, url, failmsg, func):
+    attempt = 0
+    while True:
+      try:
+        return func(self.fetcher.Fetch(url, failmsg))
+      except FetchError, e:
+        if not e.retryable or attempt >= self.retries:
+          raise
+      except (socket.error, httplib.HTTPException), e:
+        # the connection broke while reading the body.
+        if attempt >= self.retries:
+          raise FetchError('%s because of %s while tried %s' % (failmsg,
+                                                                str(e),
+                                                                url))
+      delay = self.backoff * (2 ** attempt)
+      time.sleep(delay + random.uniform(0, delay))
+      attempt += 1
+
+  def _MirrorURL(self, url):
+    with self.lock:
+      self.hedge_count += 1
+      count = self.hedge_count
+    if not self.mirrors:
+      return url
+    base = self._NormalizeURL(self.base).rstrip('/')
+    mirror = self.mirrors[count % len(self.mirrors)].rstrip('/')
+    return mirror + url[len(base):] if url.startswith(base) else url
+
+  def _HedgedGet(self, url, failmsg, func):
+    results = Queue.Queue()
+
+    def _Run(u):
+      # nothing may run after put(), the caller is free to exit by then.
+      try:
+        start = time.time()
+        try:
+          value = self._RetriedGet(u, failmsg, func)
+        except Exception, e:
+          results.put((False, e, None))
+          return
+        results.put((True, value, time.time() - start))
+      except Exception:
+        # a dropped request may still run while the interpreter shuts down
+        # and tears down the modules it uses.
+        pass
+
+    def _Start(u):
+      # the slower request can not be cancelled, it is left to finish in
+      # background and its answer is dropped.
+      worker = threading.Thread(target=_Run, args=(u,))
+      worker.daemon = True
+      worker.start()
+
+    _Start(url)
+    pending = 1
+    delay = self.latency.Percentile(self.hedge_percentile)
+    try:
+      ok, value, latency = results.get(timeout=delay) if delay is not None \
+          else results.get()
+    except Queue.Empty:
+      _Start(self._MirrorURL(url))
+      pending += 1
+      ok, value, latency = results.get()
+      # the first request took at least this long, keep the tail visible.
+      latency = max(latency, delay) if ok else latency
+    pending -= 1
+    while not ok and pending:
+      ok, value, latency = results.get()
+      pending -= 1
+    if not ok:
+      raise value
+    self.latency.Add(latency)
+    return value
 
 
 class FileDownloader(Downloader):
-  def __init__(self, fetcher, base=None):
-    Downloader.__init__(self, fetcher, base)
+  def __init__(self, fetcher, base=None, local_repository=None,
+               offline=False):
+    Downloader.__init__(self, fetcher, base, local_repository, offline)
 
   def Fetch(self, url, filename, quite=False):
     '''Fetch a file according url to filename'''
     dst_dir = os.path.dirname(filename)
     if not os.path.exists(dst_dir):
       utils.MakeDirectory(dst_dir)
-    response = self.Get(url, 'Failed to download %s' % url, lambda r: r)
-
-    if response:
-      with open(filename, 'wb') as f:
-        self._WriteChunks(response, f,
-                          report_hook=None if quite else self._ChunkReport)
-        if not quite:
-          print('Fetched file to %s' % filename)
+    # write aside and then replace, |filename| may be a hardlink into the
+    # local repository which must not be truncated.
+    tmp_filename = utils.TempPath(filename)
+
+    local_path = self.fetcher.LocalPath(self._NormalizeURL(url))
+    if local_path and not self.offline:
+      # the repository is a filesystem, let the kernel place the file.
+      try:
+        utils.LinkOrCopy(local_path, tmp_filename)
+        os.rename(tmp_filename, filename)
+      except (IOError, OSError), e:
+        raise FetchError('Failed to download %s because of %s' % (url,
+                                                                 str(e)))
+      finally:
+        if os.path.exists(tmp_filename):
+          os.remove(tmp_filename)
+      if not quite:
+        print('Placed file to %s' % filename)
       return True
-    else:
-      return False
+
+    def _Write(response):
+      # opened per attempt, a retried GET starts over.
+      with open(tmp_filename, 'wb') as f:
+        return self._WriteChunks(response, f,
+                                 report_hook=None if quite else \
+                                     self._ChunkReport)
+
+    try:
+      self.Get(url, 'Failed to download %s' % url, _Write)
+      os.rename(tmp_filename, filename)
+    finally:
+      if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    if not quite:
+      print('Fetched file to %s' % filename)
+    return True
 
   def _ChunkReport(self, bytes_so_far, chunk_size):
     sys.stdout.write('Downloaded {} bytes\r'.format(bytes_so_far))
@@ -0,0 +1,31 @@
+# file fetcher, for repositories on a local or mounted filesystem.
+
+import downloader as d
+import os
+import urllib
+import urlparse
+
+
+class FileFetcher(d.Fetcher):
+  def __init__(self):
+    pass
+
+  def LocalPath(self, url):
+    urlobject = urlparse.urlparse(url)
+    return urllib.url2pathname(urlobject.path)
+
+  def Fetch(self, url, failmsg):
+    try:
+      return open(self.LocalPath(url), 'rb')
+    except IOError, e:
+      raise d.FetchError('%s because of %s while tried %s' % (failmsg,
+                                                              str(e),
+                                                              url))
+
+
+if __name__ == '__main__':
+  f = FileFetcher()
+  assert '/mnt/repo/a b.pom' == f.LocalPath('file:///mnt/repo/a%20b.pom')
+  assert '/mnt/repo/a.pom' == f.LocalPath('/mnt/repo/a.pom')
+  assert f.Fetch(__file__, 'Failed').read(1) == '#'
+  print 'Pass'
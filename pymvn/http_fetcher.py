@@ -1,23 +1,116 @@
 # http fetcher
 
 import downloader as d
+import httplib
+import socket
+import throttle as t
+import time
 import urllib2
+import urlparse
 
 
 DEFAULT_USER_AGENT = 'pymvn downloader/1.0'
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+THROTTLED_CODES = (429, 503)
+RETRYABLE_CODES = (500, 502, 504)
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+  read_timeout = None
+
+  def connect(self):
+    # |timeout| given by urlopen only bounds connecting, reads use
+    # |read_timeout| from then on.
+    httplib.HTTPConnection.connect(self)
+    if self.read_timeout:
+      self.sock.settimeout(self.read_timeout)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+  read_timeout = None
+
+  def connect(self):
+    httplib.HTTPSConnection.connect(self)
+    if self.read_timeout:
+      self.sock.settimeout(self.read_timeout)
+
+
+class _HTTPHandler(urllib2.HTTPHandler):
+  def __init__(self, read_timeout):
+    urllib2.HTTPHandler.__init__(self)
+    self.read_timeout = read_timeout
+
+  def _Connection(self, host, **kwargs):
+    connection = _HTTPConnection(host, **kwargs)
+    connection.read_timeout = self.read_timeout
+    return connection
+
+  def http_open(self, req):
+    return self.do_open(self._Connection, req)
+
+
+class _HTTPSHandler(urllib2.HTTPSHandler):
+  def __init__(self, read_timeout):
+    urllib2.HTTPSHandler.__init__(self)
+    self.read_timeout = read_timeout
+
+  def _Connection(self, host, **kwargs):
+    connection = _HTTPSConnection(host, **kwargs)
+    connection.read_timeout = self.read_timeout
+    return connection
+
+  def https_open(self, req):
+    context = getattr(self, '_context', None)
+    if context is None:
+      return self.do_open(self._Connection, req)
+    return self.do_open(self._Connection, req, context=context)
 
 
 class HttpFetcher(d.Fetcher):
-  def __init__(self, user_agent=DEFAULT_USER_AGENT):
+  def __init__(self, user_agent=DEFAULT_USER_AGENT, throttle=None,
+               connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+               read_timeout=DEFAULT_READ_TIMEOUT):
     self.user_agent = user_agent
+    self.throttle = throttle if throttle else t.Throttle()
+    self.connect_timeout = connect_timeout
+    self.opener = urllib2.build_opener(_HTTPHandler(read_timeout),
+                                       _HTTPSHandler(read_timeout))
 
   def Fetch(self, url, failmsg):
     '''Request url by HTTP GET'''
     headers = { 'User-Agent': self.user_agent, }
     request = urllib2.Request(url, None, headers)
+    controller = self.throttle.Host(urlparse.urlparse(url).netloc)
+    controller.Acquire()
+    start = time.time()
     try:
-      return urllib2.urlopen(request)
+      response = self.opener.open(request, timeout=self.connect_timeout)
+    except urllib2.HTTPError, e:
+      controller.Release()
+      if e.code in THROTTLED_CODES:
+        # the server asks us to slow down, pause the host. Retries are left
+        # to the downloader, so that there is one retry budget.
+        controller.OnThrottled(
+            t.ParseRetryAfter(e.info().getheader('Retry-After')))
+      raise self._Error(failmsg, e, url,
+                        e.code in THROTTLED_CODES + RETRYABLE_CODES)
+    except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+      controller.Release()
+      if isinstance(e, socket.timeout) or \
+          isinstance(getattr(e, 'reason', None), socket.timeout):
+        # a stuck server, let the others take over.
+        controller.OnThrottled(0)
+      raise self._Error(failmsg, e, url, True)
     except Exception, e:
-      raise Exception('%s because of %s while tried %s' % (failmsg,
-                                                           str(e),
-                                                           url))
+      controller.Release()
+      raise self._Error(failmsg, e, url, False)
+    controller.OnResponse(time.time() - start)
+    return t.ThrottledResponse(response, controller,
+                               self.throttle.rate_limiter)
+
+  def _Error(self, failmsg, e, url, retryable):
+    return d.FetchError('%s because of %s while tried %s' % (failmsg,
+                                                             str(e),
+                                                             url),
+                        retryable)
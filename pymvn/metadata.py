@@ -1,7 +1,123 @@
 # Representing a maven metadata.xml.
 
 
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import utils
+import version as v
 import xml.etree.cElementTree as xml
+from multiprocessing.pool import ThreadPool
+
+
+UPDATE_POLICIES = [ 'always', 'daily', 'interval:N', 'never' ]
+DEFAULT_UPDATE_POLICY = 'daily'
+
+
+class UpdatePolicy(object):
+  '''
+    Maven style update policy of snapshot metadata:
+    - always: fetch on every run
+    - daily: fetch on the first run of the day
+    - interval:N: fetch when the local record is older than N minutes
+    - never: fetch only when there is no local record
+  '''
+  def __init__(self, policy=DEFAULT_UPDATE_POLICY):
+    self.policy = policy
+    self.interval = None
+    if policy.startswith('interval:'):
+      try:
+        self.interval = int(policy[len('interval:'):]) * 60
+      except ValueError:
+        raise ValueError('Invalid update policy %s' % policy)
+    elif policy not in ('always', 'daily', 'never'):
+      raise ValueError('Invalid update policy %s' % policy)
+
+  def IsStale(self, last_updated, now=None):
+    if now is None:
+      now = time.time()
+    if self.policy == 'always':
+      return True
+    elif self.policy == 'never':
+      return False
+    elif self.policy == 'daily':
+      midnight = datetime.datetime.combine(
+          datetime.date.fromtimestamp(now), datetime.time())
+      return last_updated < time.mktime(midnight.timetuple())
+    return now - last_updated >= self.interval
+
+
+class MetadataCache(object):
+  '''Keeps fetched metadata.xml for the whole run. Snapshot metadata is also
+     recorded under |cache_dir| together with the time it was fetched, and is
+     reused across runs according to |policy|.'''
+  def __init__(self, cache_dir=None, policy=DEFAULT_UPDATE_POLICY):
+    self.cache_dir = cache_dir
+    self.policy = UpdatePolicy(policy)
+    self.contents = {}
+    self.indexes = {}
+    self.lock = threading.Lock()
+
+  def _RecordPaths(self, url):
+    name = hashlib.md5(url).hexdigest()
+    path = os.path.join(self.cache_dir, 'metadata', name)
+    return path + '.xml', path + '.json'
+
+  def _Load(self, url):
+    content_path, record_path = self._RecordPaths(url)
+    if not os.path.exists(content_path) or not os.path.exists(record_path):
+      return None
+    try:
+      record = utils.ReadJson(record_path)
+    except ValueError:
+      return None
+    if record.get('url') != url or \
+        self.policy.IsStale(record.get('last_updated', 0)):
+      return None
+    with open(content_path, 'rb') as f:
+      return f.read()
+
+  def _Save(self, url, content):
+    content_path, record_path = self._RecordPaths(url)
+    utils.MakeDirectory(os.path.dirname(content_path))
+    # other processes may share |cache_dir|, the record goes last so that it
+    # never points at a partial content.
+    utils.WriteFileAtomic(content_path, content)
+    utils.WriteFileAtomic(record_path, json.dumps({
+        'url': url, 'last_updated': time.time() }))
+
+  def Get(self, downloader, url, is_snapshot):
+    with self.lock:
+      content = self.contents.get(url)
+    if content is not None:
+      return content
+
+    persist = is_snapshot and self.cache_dir
+    if persist:
+      content = self._Load(url)
+    if content is None:
+      content = downloader.Get(url, 'Failed to fetch metadata.xml',
+                               lambda r: r.read(), hedge=True,
+                               coalesce=True)
+      if persist:
+        self._Save(url, content)
+
+    with self.lock:
+      self.contents[url] = content
+    return content
+
+  def GetVersionIndex(self, downloader, arti):
+    url = downloader._NormalizeURL(_MetadataURL(downloader, arti, False))
+    with self.lock:
+      index = self.indexes.get(url)
+    if index is None:
+      index = Metadata.Parse(downloader, arti, False).GetVersionIndex()
+      with self.lock:
+        index = self.indexes.setdefault(url, index)
+    return index
 
 
 class Metadata(object):
@@ -15,22 +131,99 @@ class Metadata(object):
       version = self.arti.GetSnapshotVersion()
       timestamp = self.tree.findtext('versioning/snapshot/timestamp')
       build_number = self.tree.findtext('versioning/snapshot/buildNumber')
+      if not timestamp or not build_number:
+        # installed by 'mvn install' (<localCopy>true</localCopy>), files
+        # keep the plain -SNAPSHOT name.
+        return self.arti.version
       return version + timestamp + '-' + build_number
 
     # not snapshot
     return self.tree.findtext('versioning/latest')
 
+  def GetVersionIndex(self):
+    versions = [e.text for e in self.tree.findall('versioning/versions/version')
+                if e.text]
+    if not versions:
+      versions = [t for t in (self.tree.findtext('versioning/release'),
+                              self.tree.findtext('versioning/latest')) if t]
+    return v.VersionIndex(versions)
+
   @staticmethod
-  def Parse(downloader, arti):
-    is_snapshot = arti.IsSnapshot()
-    url = '%s/%s/maven-metadata.xml' % (downloader.base,
-                                        arti.Path(with_version=is_snapshot))
-    content = downloader.Get(url, 'Failed to fetch metadata.xml',
-                             lambda r: r.read())
+  def Parse(downloader, arti, is_snapshot=None):
+    if is_snapshot is None:
+      is_snapshot = arti.IsSnapshot()
+    downloader.used_metadata = True
+    url = _MetadataURL(downloader, arti, is_snapshot)
+    if downloader.metadata_cache:
+      content = downloader.metadata_cache.Get(downloader,
+                                              downloader._NormalizeURL(url),
+                                              is_snapshot)
+    else:
+      content = downloader.Get(url, 'Failed to fetch metadata.xml',
+                               lambda r: r.read(), hedge=True,
+                               coalesce=True)
     return Metadata(content, arti)
 
 
+def _MetadataURL(downloader, arti, is_snapshot):
+  return '%s/%s/maven-metadata.xml' % (downloader.base,
+                                       arti.Path(with_version=is_snapshot))
+
+
+def GetVersionIndex(downloader, arti):
+  '''Sorted versions of |arti|, shared by all its dependents in the run.'''
+  if downloader.metadata_cache:
+    return downloader.metadata_cache.GetVersionIndex(downloader, arti)
+  return Metadata.Parse(downloader, arti, False).GetVersionIndex()
+
+
+def ResolveVersion(downloader, arti):
+  '''Pick the version of |arti| whose version is missing or a range.'''
+  if arti.version and not v.IsRange(arti.version):
+    return arti.version
+  index = GetVersionIndex(downloader, arti)
+  if not arti.version:
+    resolved = index.Latest()
+  else:
+    resolved = index.Resolve(arti.version)
+  if not resolved:
+    raise Exception('No version of %s:%s matches %s' % (arti.group_id,
+                                                        arti.artifact_id,
+                                                        arti.version))
+  return resolved
+
+
+def ResolveSnapshots(downloader, artifacts, jobs=8):
+  '''Fill in snapshot_version of all snapshot |artifacts| in one concurrent
+     batch.'''
+  pending = [arti for arti in artifacts
+             if arti.IsSnapshot() and not arti.snapshot_version]
+  if not pending:
+    return
+  pool = ThreadPool(max(1, min(jobs, len(pending))))
+  try:
+    versions = pool.map(
+        lambda arti: Metadata.Parse(downloader, arti).GetLastversion(),
+        pending)
+  finally:
+    pool.close()
+    pool.join()
+  for arti, version in zip(pending, versions):
+    if not version:
+      raise Exception('No snapshot version of %s found' % arti)
+    arti.snapshot_version = version
+
+
 if __name__ == '__main__':
+  # Test update policy
+  now = time.time()
+  assert UpdatePolicy('always').IsStale(now, now)
+  assert not UpdatePolicy('never').IsStale(0, now)
+  assert not UpdatePolicy('daily').IsStale(now, now)
+  assert UpdatePolicy('daily').IsStale(now - 86400, now)
+  assert not UpdatePolicy('interval:10').IsStale(now - 60, now)
+  assert UpdatePolicy('interval:10').IsStale(now - 600, now)
+
   import artifact, downloader
   arti1 = artifact.Artifact.Parse('junit:junit:4.2')
   d1 = downloader.Downloader(base='http://repo1.maven.org/maven2/')
@@ -1,17 +1,28 @@
 #!/usr/bin/env python
 
 import argparse
+import copy
 import hashlib
+import json
 import os
 import sys
+import tempfile
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
-from pymvn import artifact, downloader, pom, utils
+from pymvn import artifact, downloader, metadata, pipeline, pom, throttle, \
+    utils, verify, version
 
 
-def _http_fetcher():
+def _http_fetcher(throttle, connect_timeout, read_timeout):
   from pymvn import http_fetcher as hf
-  return hf.HttpFetcher()
+  return hf.HttpFetcher(throttle=throttle,
+                        connect_timeout=connect_timeout,
+                        read_timeout=read_timeout)
+
+
+def _file_fetcher():
+  from pymvn import file_fetcher as ff
+  return ff.FileFetcher()
 
 
 def _s3_fetcher():
@@ -22,20 +33,53 @@ def _s3_fetcher():
   return sf.S3Fetcher()
 
 
+# Directory inside --cache-dir holding locks between pymvn processes, kept
+# out of the output dirs which are used as classpaths.
+LOCK_DIR = 'locks'
+
+
 class MavenDownloader(downloader.FileDownloader):
-  def __init__(self, mvn_server):
+  def __init__(self, mvn_server, cache_dir=None,
+               update_policy=metadata.DEFAULT_UPDATE_POLICY,
+               local_repository=None, offline=False,
+               max_connections=throttle.DEFAULT_MAX_CONNECTIONS,
+               max_rate=None, connect_timeout=10, read_timeout=60,
+               retries=3, mirrors=None, hedge_percentile=0):
     # ). parse url scheme to find fetcher
     import urlparse
     urlobject = urlparse.urlparse(mvn_server)
+    if not urlobject.scheme:
+      # a plain path of a repository on the filesystem.
+      mvn_server = os.path.abspath(mvn_server) + '/'
 
     # ). decide fetcher
+    t = throttle.Throttle(max_connections, max_rate)
     fetcher = {
+          '': lambda : _file_fetcher(),
+          'file': lambda : _file_fetcher(),
           's3': lambda : _s3_fetcher(),
-          'http': lambda : _http_fetcher(),
-          'https': lambda : _http_fetcher(),
+          'http': lambda : _http_fetcher(t, connect_timeout, read_timeout),
+          'https': lambda : _http_fetcher(t, connect_timeout, read_timeout),
         }[urlobject.scheme]()
 
-    downloader.FileDownloader.__init__(self, fetcher=fetcher, base=mvn_server)
+    # ). decide local repository tier
+    local = None
+    if local_repository and os.path.isdir(local_repository):
+      local = downloader.LocalRepository(local_repository,
+                                         with_metadata=offline)
+
+    downloader.FileDownloader.__init__(self, fetcher=fetcher, base=mvn_server,
+                                       local_repository=local,
+                                       offline=offline)
+    self.metadata_cache = metadata.MetadataCache(cache_dir, update_policy)
+    self.pom_cache = pom.PomCache()
+    self.retries = retries
+    self.mirrors = mirrors or []
+    self.hedge_percentile = hedge_percentile
+    # files placed by this run keyed by artifact, other output dirs (e.g. of
+    # other scopes) link them instead of fetching again.
+    self.placed = {}
+    self.lock_dir = os.path.join(cache_dir or tempfile.gettempdir(), LOCK_DIR)
 
   def Download(self, options, artifacts):
     for arti in artifacts:
@@ -46,33 +90,185 @@ class MavenDownloader(downloader.FileDownloader):
           continue
         self.DoDownload(options, sources_arti, raise_when_fail=False)
 
-  def DoDownload(self, options, arti, raise_when_fail=True):
+  def Lock(self, options, arti):
+    '''Lock between processes for placing |arti| into the output dir.'''
+    filename = arti.GetFilename(filepath=options.output_dir,
+                                detailed=options.detailed_path)
+    name = hashlib.md5(os.path.abspath(filename)).hexdigest()
+    return utils.FileLock(os.path.join(self.lock_dir, name + '.lock'))
+
+  def DoDownload(self, options, arti, raise_when_fail=True, staging_dir=None,
+                 locked=False):
+    '''Download |arti| into the output dir, or into |staging_dir| when it is
+       given. Returns the path written, or None when the output is already
+       up to date or the download was skipped. |locked| tells the caller
+       holds Lock() already, e.g. until it places the staged file.'''
     filename = arti.GetFilename(filepath=options.output_dir,
                                 detailed=options.detailed_path)
+    target = filename
+    if staging_dir:
+      target = os.path.join(staging_dir, arti.Path(with_filename=True))
     artifact_path = '{}/{}'.format(self.base, arti.Path(with_filename=True))
     try:
-      if not self._VerifyMD5(filename, artifact_path + '.md5'):
-        if not options.quite:
-          print('Start to fetch %s' % str(arti))
-        self.Fetch(artifact_path, filename, options.quite)
-      else:
-        if not options.quite:
-          print('%s is already up to date' % str(arti))
+      # one process downloads |filename|, the others wait and find it up to
+      # date afterwards.
+      lock = self.Lock(options, arti) if not locked else None
+      if lock:
+        lock.Acquire()
+      try:
+        target = self._DoDownload(options, arti, filename, target,
+                                  artifact_path)
+      finally:
+        if lock:
+          lock.Release()
+      if target is None or target == filename:
+        self.placed[str(arti)] = filename
+      return target
     except Exception as e:
       if raise_when_fail:
         raise e
       elif not options.quite:
         print('%s fetch error, skip' % str(arti))
+    return None
+
+  def _FindPlaced(self, arti, filename):
+    placed = self.placed.get(str(arti))
+    if placed and placed != filename and os.path.exists(placed):
+      return placed
+    return None
+
+  def _DoDownload(self, options, arti, filename, target, artifact_path):
+    local_path = self._FindPlaced(arti, filename) or \
+        self.FindLocal(artifact_path)
+    if local_path:
+      utils.MakeDirectory(os.path.dirname(target))
+      utils.LinkOrCopy(local_path, target)
+      if not options.quite:
+        print('%s is linked from %s' % (str(arti), local_path))
+    elif not self._VerifyMD5(filename, artifact_path):
+      if not options.quite:
+        print('Start to fetch %s' % str(arti))
+      self.Fetch(artifact_path, target, options.quite)
+    else:
+      if not options.quite:
+        print('%s is already up to date' % str(arti))
+      return None
+    return target
   
-  def _VerifyMD5(self, filename, url_path):
-    remote_md5 = self.Get(url_path, 'Failed to fetch MD5', lambda r: r.read())
-    return utils.VerifyMD5(filename, remote_md5)
+  def _VerifyMD5(self, filename, artifact_path):
+    if not os.path.exists(filename):
+      return False
+    return utils.VerifyMD5(filename, self.GetMD5(artifact_path))
   
 
+# Options which do not change what gets downloaded.
+_STAMP_IGNORED_OPTIONS = [ 'stamp', 'depfile', 'quite', 'jobs',
+                           'max_connections', 'max_rate', 'connect_timeout',
+                           'read_timeout', 'retries', 'mirror',
+                           'hedge_percentile', 'pipeline' ]
+
+
+def _InputsHash(options):
+  inputs = dict((k, v) for k, v in vars(options).iteritems()
+                if k not in _STAMP_IGNORED_OPTIONS)
+  return hashlib.md5(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _IsStampUpToDate(options, inputs_hash):
+  if not os.path.exists(options.stamp):
+    return False
+  try:
+    record = utils.ReadJson(options.stamp)
+  except ValueError:
+    return False
+  if record.get('inputs') != inputs_hash:
+    return False
+  # versions picked according metadata.xml anywhere in the graph are looked
+  # up again.
+  if record.get('dynamic', True) and options.update_policy != 'never':
+    return False
+  outputs = record.get('outputs', [])
+  if not all(os.path.exists(f) for f in outputs):
+    return False
+  if options.depfile and not os.path.exists(options.depfile):
+    return False
+  # an output modified after the stamp was written is no longer ours.
+  return not utils.IsTimeStale(options.stamp, outputs)
+
+
+def _ScopeOptions(options, scopes):
+  '''Options of each scope, files of a scope go to a sub dir named after it
+     when more than one scope is asked for.'''
+  if len(scopes) == 1:
+    return [(scopes[0], options)]
+  result = []
+  for scope in scopes:
+    scope_options = copy.copy(options)
+    scope_options.output_dir = os.path.join(options.output_dir, scope)
+    result.append((scope, scope_options))
+  return result
+
+
+def _Outputs(options, artifacts):
+  outputs = []
+  for arti in artifacts:
+    outputs.append(arti.GetFilename(filepath=options.output_dir,
+                                    detailed=options.detailed_path))
+    if options.with_sources:
+      sources_arti = arti.GenerateSourcesJarArtifact()
+      if sources_arti is not None and sources_arti is not arti:
+        filename = sources_arti.GetFilename(filepath=options.output_dir,
+                                            detailed=options.detailed_path)
+        if os.path.exists(filename):
+          outputs.append(filename)
+  return outputs
+
+
+def _WriteStamp(options, inputs_hash, outputs, dynamic):
+  outputs = sorted(set(outputs))
+  if options.depfile:
+    utils.WriteDepfile(options.depfile, options.stamp, outputs)
+  utils.MakeDirectory(os.path.dirname(options.stamp))
+  utils.WriteJson({ 'inputs': inputs_hash, 'outputs': outputs,
+                    'dynamic': dynamic },
+                  options.stamp, only_if_changed=True)
+  if utils.IsTimeStale(options.stamp, outputs):
+    utils.Touch(options.stamp)
+
+
+def _ReportDuplicateClasses(options, artifacts):
+  jars = {}
+  for arti in artifacts:
+    filename = arti.GetFilename(filepath=options.output_dir,
+                                detailed=options.detailed_path)
+    if arti.extension == 'jar' and os.path.exists(filename):
+      jars[filename] = arti
+  duplicates = utils.FindDuplicateClasses(jars.keys(),
+                                          cache_dir=options.cache_dir)
+  overlaps = {}
+  for c, owners in duplicates.iteritems():
+    overlaps.setdefault(tuple(sorted(owners)), []).append(c)
+  for owners, classes in sorted(overlaps.iteritems()):
+    utils.PrintWarning('%s share %d classes, e.g. %s' % (
+        ', '.join(str(jars[o]) for o in owners), len(classes),
+        sorted(classes)[0]))
+  return duplicates
+
+
 def DoMain(argv):
-  description = 'Fetch binary according maven coordinate protocol.'
+  # 'verify' checks --output-dir against the server instead of downloading.
+  verify_mode = len(argv) > 0 and argv[0] == 'verify'
+  if verify_mode:
+    argv = argv[1:]
+
+  description = 'Fetch binary according maven coordinate protocol. ' \
+                'Run as "pymvn verify ..." to report mismatched, missing ' \
+                'and extra files of --output-dir instead.'
   parser = argparse.ArgumentParser(description=description)
-  parser.add_argument('--mvn-server', help='Custom maven server')
+  parser.add_argument('--mvn-server',
+                      help='Custom maven server, an http(s):// or s3:// url, '
+                           'or a file:// url or path of a repository on the '
+                           'filesystem')
   parser.add_argument('--output-dir',
                       required=True,
                       help='Directory to save downloaded files')
@@ -92,38 +288,207 @@ def DoMain(argv):
                       action='store_true',
                       default=False,
                       help='Do not output logs')
+  parser.add_argument('--cache-dir',
+                      default=os.path.join(os.path.expanduser('~'), '.pymvn'),
+                      help='Directory to keep local records, '
+                           'e.g. snapshot metadata')
+  parser.add_argument('--update-policy',
+                      default=metadata.DEFAULT_UPDATE_POLICY,
+                      help='Update policy of snapshot metadata, one of %s' %
+                           ', '.join(metadata.UPDATE_POLICIES))
+  parser.add_argument('--local-repository',
+                      default=os.path.join(os.path.expanduser('~'),
+                                           '.m2', 'repository'),
+                      help='Local maven repository consulted before '
+                           '--mvn-server, ignored when it does not exist')
+  parser.add_argument('--offline',
+                      action='store_true',
+                      default=False,
+                      help='Only use --local-repository, never the network')
+  parser.add_argument('--max-connections',
+                      type=int,
+                      default=throttle.DEFAULT_MAX_CONNECTIONS,
+                      help='Upper bound of concurrent requests per host, '
+                           'the actual number adapts to server feedback')
+  parser.add_argument('--max-rate',
+                      type=int,
+                      default=None,
+                      help='Cap download speed in bytes per second')
+  parser.add_argument('--connect-timeout',
+                      type=float,
+                      default=10,
+                      help='Seconds to wait for a connection')
+  parser.add_argument('--read-timeout',
+                      type=float,
+                      default=60,
+                      help='Seconds to wait for data on a connection')
+  parser.add_argument('--retries',
+                      type=int,
+                      default=3,
+                      help='Times to retry a failed request, with '
+                           'exponential backoff')
+  parser.add_argument('--mirror',
+                      action='append',
+                      default=[],
+                      help='Mirror of --mvn-server used by hedged requests, '
+                           'can be given multiple times')
+  parser.add_argument('--hedge-percentile',
+                      type=float,
+                      default=0,
+                      help='Send a second request for a pom or metadata once '
+                           'the first is slower than this percentile of '
+                           'recent ones, to the next --mirror or to '
+                           '--mvn-server again. Off by default (0), e.g. 95 '
+                           'turns it on')
+  parser.add_argument('--pipeline',
+                      action='store_true',
+                      default=False,
+                      help='Start downloading while dependencies are still '
+                           'being resolved')
+  parser.add_argument('--check-duplicate-classes',
+                      action='store_true',
+                      default=False,
+                      help='Warn about classes found in more than one '
+                           'downloaded jar')
+  parser.add_argument('--stamp',
+                      help='File recording inputs and outputs of this run, '
+                           'later runs with the same inputs and intact '
+                           'outputs exit at once')
+  parser.add_argument('--depfile',
+                      help='Write a depfile listing downloaded files as '
+                           'dependencies of --stamp')
+  parser.add_argument('--scope',
+                      action='append',
+                      choices=pom.SCOPES,
+                      help='Scope of the classpath to fetch, compile by '
+                           'default. Can be given multiple times, each scope '
+                           'is then put into a sub dir of --output-dir')
+  parser.add_argument('--exclude',
+                      action='append',
+                      help='Skip dependencies matching group[:artifact], '
+                           'wildcards allowed. Can be given multiple times '
+                           'and replaces the default %s' %
+                           ' '.join(pom.DEFAULT_EXCLUDES))
+  parser.add_argument('--jobs',
+                      type=int,
+                      default=8,
+                      help='Number of concurrent requests')
   parser.add_argument('coordinate',
                       nargs='+',
                       help='Maven coordinate')
 
   options = parser.parse_args(argv)
+  if options.depfile and not options.stamp:
+    parser.error('--depfile requires --stamp')
+  scopes = []
+  for scope in options.scope or ['compile']:
+    if scope not in scopes:
+      scopes.append(scope)
+  scope_options = _ScopeOptions(options, scopes)
+  try:
+    metadata.UpdatePolicy(options.update_policy)
+  except ValueError as e:
+    parser.error(str(e))
+  try:
+    for e in options.exclude or []:
+      pom.ParseExclude(e)
+  except Exception as e:
+    parser.error(str(e))
+
+  # nothing to do when inputs are the same as last time.
+  inputs_hash = None
+  if options.stamp and not verify_mode and not options.print_only:
+    inputs_hash = _InputsHash(options)
+    if _IsStampUpToDate(options, inputs_hash):
+      return
 
   # prepare downloader.
   mvn_url = 'http://repo1.maven.org/maven2/' if not options.mvn_server \
       else options.mvn_server
-  d = MavenDownloader(mvn_url)
+  d = MavenDownloader(mvn_url,
+                      cache_dir=options.cache_dir,
+                      update_policy=options.update_policy,
+                      local_repository=options.local_repository,
+                      offline=options.offline,
+                      max_connections=options.max_connections,
+                      max_rate=options.max_rate,
+                      connect_timeout=options.connect_timeout,
+                      read_timeout=options.read_timeout,
+                      retries=options.retries,
+                      mirrors=options.mirror,
+                      hedge_percentile=options.hedge_percentile)
 
   # prepare pending artifacts.
   artifacts = []
   for coordinate in options.coordinate:
-    artifacts.append(artifact.Artifact.Parse(coordinate, downloader=d))
+    arti = artifact.Artifact.Parse(coordinate)
+    if version.IsRange(arti.version):
+      arti = arti.Copy(version=metadata.ResolveVersion(d, arti))
+    artifacts.append(arti)
+  # resolve all snapshot versions in one batch before walking the graph.
+  metadata.ResolveSnapshots(d, artifacts, jobs=options.jobs)
 
-  # parse all dependencise according coordinate inputs.
-  download_artifacts = []
-  for arti in artifacts:
-    p = pom.Pom.Parse(d, arti)
-    download_artifacts.extend(p.GetCompileNeededArtifacts())
+  # download in background while resolving when asked to.
+  p_line = None
+  if options.pipeline and not verify_mode and not options.print_only:
+    p_line = pipeline.Pipeline(d, scope_options[0][1], artifacts,
+                               jobs=options.jobs)
+
+  try:
+    # parse all dependencise of all scopes according coordinate inputs in
+    # one walk, versions are slimmed for each scope alone.
+    resolver = pom.Resolver(d, scopes,
+                            listener=p_line.Submit if p_line else None,
+                            excludes=options.exclude)
+    download_artifacts = resolver.Resolve(artifacts)
 
-  # slim the all in one dependencise list, we know we are doing here!
-  download_artifacts = pom.Pom.Slim(download_artifacts, artifacts)
+    if p_line:
+      for scope, o in scope_options:
+        p_line.Finish(download_artifacts[scope], o)
+  finally:
+    if p_line:
+      p_line.Close()
+
+  if verify_mode:
+    clean = True
+    for scope, o in scope_options:
+      sources_artifacts = []
+      if options.with_sources:
+        sources_artifacts = [arti.GenerateSourcesJarArtifact()
+                             for arti in download_artifacts[scope]]
+      report = verify.Verify(d, o.output_dir, download_artifacts[scope],
+                             [arti for arti in sources_artifacts if arti],
+                             detailed=options.detailed_path,
+                             jobs=options.jobs)
+      for line in report.Lines():
+        print(line)
+      clean = clean and report.IsClean()
+    if not clean:
+      # an expected outcome of an audit, not an error of pymvn.
+      sys.stderr.write('Failed to verify %s\n' % options.output_dir)
+      sys.exit(1)
+    return
 
   if options.print_only:
     utils.CheckOptions(options, parser, required=['output_dir'])
-    return ' '.join([arti.GetFilename(filepath=options.output_dir,
-                                      detailed=options.detailed_path) \
-                     for arti in download_artifacts])
-  
-  d.Download(options, download_artifacts) 
+    lines = []
+    for scope, o in scope_options:
+      files = ' '.join([arti.GetFilename(filepath=o.output_dir,
+                                         detailed=options.detailed_path) \
+                        for arti in download_artifacts[scope]])
+      lines.append(files if len(scopes) == 1 else '%s: %s' % (scope, files))
+    return '\n'.join(lines)
+
+  outputs = []
+  for scope, o in scope_options:
+    if not p_line:
+      d.Download(o, download_artifacts[scope])
+    if options.check_duplicate_classes:
+      _ReportDuplicateClasses(o, download_artifacts[scope])
+    outputs.extend(_Outputs(o, download_artifacts[scope]))
+
+  if inputs_hash:
+    _WriteStamp(options, inputs_hash, outputs, d.used_metadata)
 
 
 def main():
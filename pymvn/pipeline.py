@@ -0,0 +1,240 @@
+# Download artifacts while the dependency graph is still being resolved.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import utils
+import version as v
+from multiprocessing.pool import ThreadPool
+
+
+class _Job(object):
+  def __init__(self, arti, optional):
+    self.arti = arti
+    self.optional = optional
+    self.cancelled = False
+    self.result = None
+    # the lock between processes held from staging until placing.
+    self.file_lock = None
+
+
+class Pipeline(object):
+  '''
+    Starts downloading an artifact as soon as its pom is parsed. Versions of
+    |inputs| are final, the others may still be raised by mediation (see
+    pom.Pom.Slim), so downloads go to a staging dir first and only those of
+    the final versions are moved into the output dir by Finish(). Downloads
+    superseded by a higher version are cancelled when not started yet, or
+    discarded.
+
+    A download holds the lock of its output file (see MavenDownloader.Lock)
+    until the staged file is placed, so that other processes wait for it.
+    It never waits for a lock of another process though, and leaves busy
+    files to Finish(), which waits only after releasing all locks held, so
+    that processes cannot wait on each other.
+  '''
+  def __init__(self, d, options, inputs, jobs=8):
+    self.d = d
+    self.options = options
+    self.pinned = dict((arti.Key(), arti.version) for arti in inputs)
+    utils.MakeDirectory(options.output_dir)
+    # inside the output dir, so that placing a file is a rename.
+    self.staging_dir = tempfile.mkdtemp(prefix='.pymvn-',
+                                        dir=options.output_dir)
+    self.pool = ThreadPool(max(1, jobs))
+    self.jobs = {}
+    # superseded jobs, which may still hold their locks.
+    self.superseded = []
+    self.lock = threading.Lock()
+    # set once Finish() released the locks, downloads do not start anymore.
+    self.finishing = False
+
+  def Submit(self, arti):
+    self._Submit(arti, False)
+    if self.options.with_sources:
+      sources_arti = arti.GenerateSourcesJarArtifact()
+      if sources_arti is not None and sources_arti is not arti:
+        self._Submit(sources_arti, True)
+
+  def _Submit(self, arti, optional):
+    key = arti.Key()
+    pinned = self.pinned.get(key)
+    if pinned is not None and pinned != arti.version:
+      return
+    with self.lock:
+      job = self.jobs.get(key)
+      if job is not None:
+        if job.arti.version == arti.version or \
+            v.Compare(arti.version, job.arti.version) < 0:
+          return
+        # superseded by mediation.
+        job.cancelled = True
+        self.superseded.append(job)
+      job = _Job(arti, optional)
+      job.result = self.pool.apply_async(self._Run, (job,))
+      self.jobs[key] = job
+
+  def _Run(self, job):
+    if job.cancelled:
+      return None
+    file_lock = self.d.Lock(self.options, job.arti)
+    if not file_lock.Acquire(blocking=False):
+      # another process is on it, Finish() waits for it.
+      return None
+    with self.lock:
+      if self.finishing:
+        file_lock.Release()
+        return None
+      job.file_lock = file_lock
+    try:
+      return self.d.DoDownload(self.options, job.arti,
+                               raise_when_fail=not job.optional,
+                               staging_dir=self.staging_dir, locked=True)
+    finally:
+      if job.cancelled:
+        self._ReleaseLock(job)
+
+  def _ReleaseLock(self, job):
+    with self.lock:
+      file_lock, job.file_lock = job.file_lock, None
+    if file_lock:
+      file_lock.Release()
+
+  def _ReleaseLocks(self):
+    with self.lock:
+      self.finishing = True
+      jobs = self.jobs.values() + self.superseded
+    for job in jobs:
+      self._ReleaseLock(job)
+
+  def Finish(self, artifacts, options=None):
+    '''Place the final |artifacts| into the output dir, or the one of
+       |options| when given, downloading those not started yet. The output
+       dir of the pipeline goes first.'''
+    options = options or self.options
+    pending = []
+    for arti in artifacts:
+      pending.append((arti, False))
+      if self.options.with_sources:
+        sources_arti = arti.GenerateSourcesJarArtifact()
+        if sources_arti is not None:
+          pending.append((sources_arti, True))
+    if options is self.options:
+      pending = [(arti, optional) for arti, optional in pending
+                 if not self._PlaceStaged(arti)]
+      self._ReleaseLocks()
+    for arti, optional in pending:
+      self._Place(options, arti, optional)
+
+  def _GetJob(self, arti):
+    with self.lock:
+      job = self.jobs.get(arti.Key())
+    if job is None or job.arti.version != arti.version:
+      return None
+    return job
+
+  def _PlaceStaged(self, arti):
+    '''Place |arti| when its download holds the lock, returns whether it
+       did.'''
+    job = self._GetJob(arti)
+    if job is None:
+      return False
+    staged = job.result.get()
+    with self.lock:
+      file_lock, job.file_lock = job.file_lock, None
+    if file_lock is None:
+      return False
+    try:
+      if staged:
+        filename = arti.GetFilename(filepath=self.options.output_dir,
+                                    detailed=self.options.detailed_path)
+        utils.MakeDirectory(os.path.dirname(filename))
+        os.rename(staged, filename)
+        self.d.placed[str(arti)] = filename
+    finally:
+      file_lock.Release()
+    return True
+
+  def _Place(self, options, arti, optional):
+    job = self._GetJob(arti)
+    if job is not None and str(arti) not in self.d.placed:
+      staged = job.result.get()
+      if staged:
+        # downloaded for another output dir, link it from the staging dir.
+        self.d.placed[str(arti)] = staged
+    self.d.DoDownload(options, arti, raise_when_fail=not optional)
+
+  def Close(self):
+    with self.lock:
+      for job in self.jobs.values():
+        job.cancelled = True
+    self.pool.close()
+    self.pool.join()
+    self._ReleaseLocks()
+    shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  import argparse
+  import mvn
+  Parse = mvn.artifact.Artifact.Parse
+
+  repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test',
+                      'data', 'repo')
+  with utils.TempDir() as tmp:
+    d = mvn.MavenDownloader(repo, cache_dir=os.path.join(tmp, 'cache'))
+    root = Parse('pymvn.test:pl:1.0')
+    b = Parse('pymvn.test:b:1.0')
+    c1 = Parse('pymvn.test:c:1.0')
+    c2 = Parse('pymvn.test:c:2.0')
+
+    def Check(output_dir, artifacts):
+      assert sorted(os.listdir(output_dir)) == sorted(
+          arti.GetFilename() for arti in artifacts), os.listdir(output_dir)
+      for arti in artifacts:
+        with open(os.path.join(output_dir, arti.GetFilename())) as f:
+          assert f.read() == '%s\n' % arti
+
+    # Test c 1.0 superseded by c 2.0 before it starts, the pool is kept busy
+    # meanwhile.
+    options = argparse.Namespace(output_dir=os.path.join(tmp, 'out1'),
+                                 detailed_path=False, with_sources=False,
+                                 quite=True)
+    p_line = Pipeline(d, options, [root], jobs=1)
+    try:
+      busy = threading.Event()
+      p_line.pool.apply_async(busy.wait)
+      for arti in [root, c1, b, c2]:
+        p_line.Submit(arti)
+      assert [str(job.arti) for job in p_line.superseded] == [str(c1)]
+      assert p_line.superseded[0].cancelled
+      busy.set()
+      assert p_line.superseded[0].result.get() is None
+      p_line.Finish([root, c2, b])
+      staged = p_line.staging_dir
+      assert d.placed[str(c2)] == os.path.join(options.output_dir, 'c.jar')
+    finally:
+      p_line.Close()
+    assert not os.path.exists(staged)
+    Check(options.output_dir, [root, c2, b])
+
+    # Test c 1.0 superseded once downloaded, through the resolver.
+    options = argparse.Namespace(output_dir=os.path.join(tmp, 'out2'),
+                                 detailed_path=False, with_sources=False,
+                                 quite=True)
+    p_line = Pipeline(d, options, [root])
+    try:
+      p_line.Submit(c1)
+      assert p_line.jobs[c1.Key()].result.get()
+      resolver = mvn.pom.Resolver(d, ['compile'], listener=p_line.Submit)
+      artifacts = resolver.Resolve([root])['compile']
+      assert [str(arti) for arti in artifacts] == [str(root), str(c2), str(b)]
+      p_line.Finish(artifacts)
+    finally:
+      p_line.Close()
+    Check(options.output_dir, [root, c2, b])
+    assert os.listdir(os.path.join(tmp, 'cache', mvn.LOCK_DIR))
+
+  print 'Pass'
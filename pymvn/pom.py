@@ -2,76 +2,173 @@
 
 
 import artifact as a
+import fnmatch
 import metadata as m
+import threading
+import version as v
 import xml.etree.cElementTree as xml
 
 
 POM_NS = '{http://maven.apache.org/POM/4.0.0}'
-PROJECT_VERSION = '${project.version}'
 
-IGNORE_DEPENDENCIES = [ 'javax.', 'com.sun.', ]
+# Dependencies skipped unless other excludes are given, as group[:artifact].
+DEFAULT_EXCLUDES = [ 'javax.*', 'com.sun.*', ]
 KNOWN_PACKAGES = [ 'jar', 'war', 'so', 'a', 'zip', 'rar', '7z' ]
 
+SCOPES = [ 'compile', 'provided', 'runtime', 'test' ]
+# Scopes of the dependencies making up the classpath of each scope.
+CLASSPATH_SCOPES = {
+    'compile': ('compile',),
+    'provided': ('compile', 'provided'),
+    'runtime': ('compile', 'runtime'),
+    'test': ('compile', 'provided', 'runtime', 'test'),
+}
+# Maven scope propagation: the scope of a transitive dependency by the scope
+# of the dependency pulling it in and the scope it is declared with.
+# Transitive provided and test dependencies are dropped.
+TRANSITIVE_SCOPES = {
+    'compile': { 'compile': 'compile', 'runtime': 'runtime' },
+    'provided': { 'compile': 'provided', 'runtime': 'provided' },
+    'runtime': { 'compile': 'runtime', 'runtime': 'runtime' },
+    'test': { 'compile': 'test', 'runtime': 'test' },
+}
 
-def _InIgnoreDependencies(dep):
-  for d in IGNORE_DEPENDENCIES:
-    if dep.startswith(d):
+
+def ParseExclude(text):
+  '''Parse group[:artifact] into an exclusion, both may use wildcards.'''
+  parts = text.split(':')
+  if len(parts) > 2 or not parts[0]:
+    raise Exception('Invalid exclude %s, expect group[:artifact]' % text)
+  return (parts[0], parts[1] if len(parts) == 2 and parts[1] else '*')
+
+
+def _IsExcluded(exclusions, group_id, artifact_id):
+  for group, artifact in exclusions:
+    if fnmatch.fnmatchcase(group_id or '', group) and \
+        fnmatch.fnmatchcase(artifact_id or '', artifact):
       return True
   return False
 
 
-# TODO introduce true tree dependencise analyze & runtime dependencise support
+def _ResolveArtifact(downloader, coordinate):
+  '''Artifact of a (groupId, artifactId, version) |coordinate|, picking the
+     version according metadata.xml when it is missing or a range. The
+     snapshot version is left to the caller, see metadata.ResolveSnapshots.'''
+  group_id, artifact_id, version = coordinate
+  if not version or v.IsRange(version):
+    version = m.ResolveVersion(downloader,
+                               a.Artifact(group_id, artifact_id, version))
+  return a.Artifact(group_id, artifact_id, version)
+
+
 class Pom(object):
   def __init__(self, downloader, content, arti):
     self.downloader = downloader
     self.content = content
     self.this_artifact = arti
     self.tree = xml.fromstring(content)
-    self.parent_artifact = self._GetParent()
+    self.parent_artifact = None
     self.parent_pom = None
+    self.parent_artifact = self._GetParent()
+    # versions of dependencyManagement keyed by (groupId, artifactId), see
+    # GetManagedVersions().
+    self.managed = None
     self._UpdateExtension()
 
   def _UpdateExtension(self):
     ext = self.tree.findtext('%spackaging' % POM_NS)
     if ext:
-      if ext in KNOWN_PACKAGES:
-        self.this_artifact.extension = ext
+      if ext in KNOWN_PACKAGES and ext != self.this_artifact.extension:
+        self.this_artifact = self.this_artifact.Copy(extension=ext)
       #else:
       #  print('Packaging[%s] is not in known package list'
       #        ' while parsing %s, ignore it' % (ext, self.this_artifact))
 
+  def _GetParentPom(self):
+    if not self.parent_pom and self.parent_artifact:
+      self.parent_pom = Pom.ParseShared(self.downloader,
+                                        self.parent_artifact)
+    return self.parent_pom
+
   def _GetProperty(self, p):
     key = '%sproperties/%s%s' % (POM_NS, POM_NS, p)
     value = self.tree.findtext(key)
-    if not value:
-      if not self.parent_pom:
-        self.parent_pom = Pom.Parse(self.downloader, self.parent_artifact)
+    if not value and self._GetParentPom():
       value = self.parent_pom._GetProperty(p)
     return value
 
-  def _BuildArtifact(self, tree):
-    group_id = tree.findtext('%sgroupId'  % POM_NS)
-    artifact_id = tree.findtext('%sartifactId'  % POM_NS)
-    version = tree.findtext('%sversion'  % POM_NS)
+  def _Expand(self, text):
+    # property should in form of ${key}
+    if not text or not text.startswith('${'):
+      return text
+    key = text[2:-1]
+    if key in ('project.version', 'pom.version'):
+      return self.this_artifact.version
+    if key in ('project.groupId', 'pom.groupId'):
+      return self.this_artifact.group_id
+    if key == 'project.parent.version' and self.parent_artifact:
+      return self.parent_artifact.version
+    return self._GetProperty(key)
 
-    if version == PROJECT_VERSION:
-      version = self.parent_artifact.version
+  def GetManagedVersions(self):
+    '''Versions of the dependencyManagement of this pom merged over those of
+       its parents, plus those of imported boms not managed otherwise. Keyed
+       by (groupId, artifactId). Poms without a dependencyManagement share
+       the dict of their parent.'''
+    if self.managed is not None:
+      return self.managed
+    parent = self._GetParentPom()
+    inherited = parent.GetManagedVersions() if parent else {}
+    entries = self.tree.findall(
+        '%sdependencyManagement/%sdependencies/%sdependency' % (POM_NS, POM_NS,
+                                                                POM_NS))
+    if not entries:
+      self.managed = inherited
+      return self.managed
 
-    arti = a.Artifact(group_id, artifact_id, version)
+    managed = dict(inherited)
+    boms = []
+    for d in entries:
+      group_id = self._Expand(d.findtext('%sgroupId' % POM_NS))
+      artifact_id = self._Expand(d.findtext('%sartifactId' % POM_NS))
+      version = self._Expand(d.findtext('%sversion' % POM_NS))
+      if not version:
+        continue
+      if d.findtext('%sscope' % POM_NS) == 'import':
+        boms.append(a.Artifact(group_id, artifact_id, version))
+      else:
+        managed[(group_id, artifact_id)] = version
+    # as Maven does, imported entries never override inherited or own ones,
+    # and the first bom managing an artifact wins.
+    m.ResolveSnapshots(self.downloader, boms)
+    for bom in boms:
+      for key, version in Pom.ParseShared(self.downloader,
+                                          bom).GetManagedVersions().iteritems():
+        managed.setdefault(key, version)
+    self.managed = managed
+    return self.managed
+
+  def _GetCoordinate(self, tree, managed=True):
+    '''(groupId, artifactId, version) of |tree| with properties expanded.
+       The version may still be missing or a range, see _ResolveArtifact.'''
+    group_id = self._Expand(tree.findtext('%sgroupId'  % POM_NS))
+    artifact_id = self._Expand(tree.findtext('%sartifactId'  % POM_NS))
+    version = self._Expand(tree.findtext('%sversion'  % POM_NS))
 
     # check artifact version
-    if not arti.version:
-      # try to find out version according metadata.xml
-      arti.version = m.Metadata.Parse(self.downloader,
-                                      arti).GetLastversion()
-    elif arti.version.startswith('${'):
-      # property should in form of ${key}
-      arti.version = self._GetProperty(arti.version[2:-1])
+    if not version and managed:
+      # managed by dependencyManagement of this pom, its parents or boms.
+      version = self.GetManagedVersions().get((group_id, artifact_id))
+    return (group_id, artifact_id, version)
+
+  def _BuildArtifact(self, tree, managed=True):
+    arti = _ResolveArtifact(self.downloader,
+                            self._GetCoordinate(tree, managed))
 
     # check whether artifact is a snapshot version
     if arti.IsSnapshot():
-      arti.snapshot_version = m.Metadata(self.downloader,
-                                         arti).GetLastversion()
+      arti.snapshot_version = m.Metadata.Parse(self.downloader,
+                                               arti).GetLastversion()
       assert arti.snapshot_version
 
     #print '%s - %s' % (str(self.this_artifact), str(arti))
@@ -85,38 +182,61 @@ class Pom(object):
     elif len(parent) > 1:
       raise Exception('More than one parent?')
     else:
-      return self._BuildArtifact(parent[0])
+      # the managed versions are only known once the parent is.
+      return self._BuildArtifact(parent[0], managed=False)
 
-  def _GetCompileDependencies(self, parent_needs):
-    parent_str_needs = [str(a) for a in parent_needs] if parent_needs else []
+  def _GetExclusions(self, tree):
+    exclusions = []
+    for e in tree.findall('%sexclusions/%sexclusion' % (POM_NS, POM_NS)):
+      exclusions.append(
+          (self._Expand(e.findtext('%sgroupId' % POM_NS)) or '*',
+           self._Expand(e.findtext('%sartifactId' % POM_NS)) or '*'))
+    return exclusions
+
+  def GetDependencies(self, scopes=SCOPES, excludes=()):
+    '''Dependencies as (coordinate, scope, exclusions) tuples, with their
+       declared scope and their own exclusions. Coordinates are as given by
+       _GetCoordinate, no metadata.xml is fetched for them here. Optional
+       dependencies, those of other |scopes| and those matching |excludes|
+       are skipped.'''
     dep = []
     for d in self.tree.findall('%sdependencies/%sdependency' % (POM_NS,
                                                                 POM_NS)):
-      scope = d.findtext('%sscope' % POM_NS)
-      if scope and scope != 'compile':
-        # skip all the dependencise except for 'compile' and None
-        continue
       optional = d.findtext('%soptional' % POM_NS)
       if optional and optional == 'true':
         # skip optional dependency
         continue
-      pending_arti = self._BuildArtifact(d) 
-      if str(pending_arti) not in parent_str_needs and \
-          not _InIgnoreDependencies(pending_arti.group_id):
-        dep.append(pending_arti)
+      scope = d.findtext('%sscope' % POM_NS) or 'compile'
+      if scope not in scopes:
+        continue
+      # as written, ids may be properties like ${project.groupId}.
+      if _IsExcluded(excludes,
+                     self._Expand(d.findtext('%sgroupId' % POM_NS)),
+                     self._Expand(d.findtext('%sartifactId' % POM_NS))):
+        continue
+      dep.append((self._GetCoordinate(d), scope,
+                  frozenset(self._GetExclusions(d))))
     return dep
 
-  def GetCompileNeededArtifacts(self, parent_needs=None):
-    needs = [ self.this_artifact ]
-    for arti in self._GetCompileDependencies(parent_needs):
-      needs.extend(Pom.Parse(self.downloader,
-                             arti).GetCompileNeededArtifacts(needs))
-    return Pom.Slim(needs)
+  def GetCompileNeededArtifacts(self, parent_needs=None, listener=None,
+                                excludes=None):
+    '''|listener| is called with every artifact once its pom is parsed.'''
+    resolver = Resolver(self.downloader, ['compile'], listener, excludes)
+    resolver.AddPom(self)
+    return resolver.Resolve([self.this_artifact], parent_needs)['compile']
+
+  @staticmethod
+  def ParseShared(downloader, arti):
+    '''Parse a pom shared by many others, like a parent or a bom.'''
+    if downloader.pom_cache is not None:
+      return downloader.pom_cache.Get(downloader, arti)
+    return Pom.Parse(downloader, arti)
 
   @staticmethod
   def Parse(downloader, arti):
     url = '%s/%s/%s' % (downloader.base, arti.Path(), arti.GetPom())
-    content = downloader.Get(url, 'Failed to fetch pom.xml', lambda r: r.read())
+    content = downloader.Get(url, 'Failed to fetch pom.xml', lambda r: r.read(),
+                             hedge=True, coalesce=True)
     return Pom(downloader, content, arti)
 
   @staticmethod
@@ -125,33 +245,217 @@ class Pom(object):
        Note that we will keep the |input_dependencies| version while removing
        duplicate dependencies.'''
     dependencies = []
+    seen = {}
     # remove the duplicate dependency.
     for arti in origin_dependencies:
-      match = False
-      for new in dependencies:
-        if arti.ArtifactEquel(new):
-          match = True
-          if cmp(arti.version, new.version) > 0:
-            # Trick: compare version in str,
-            #  always use the highest version of dependency.
-            new.version = arti.version
-          break
-      if not match:
+      i = seen.get(arti.Key())
+      if i is None:
+        seen[arti.Key()] = len(dependencies)
         dependencies.append(arti)
+      elif v.Compare(arti.version, dependencies[i].version) > 0:
+        # always use the highest version of dependency.
+        dependencies[i] = arti
     # final check dependencies, make sure final dependency appear in
     # |input_dependencies| should share the same version.
     if input_dependencies:
-      for dep in dependencies:
-        for input_dep in input_dependencies:
-          if dep.ArtifactEquel(input_dep):
-            dep.version = input_dep.version
-            break
+      for input_dep in reversed(input_dependencies):
+        i = seen.get(input_dep.Key())
+        if i is not None:
+          dependencies[i] = input_dep
     return dependencies
 
 
+class PomCache(object):
+  '''Parents and boms parsed in this run (see Pom.ParseShared), so that
+     those shared by many poms, and their managed versions, are fetched and
+     computed once. Other poms are not kept.'''
+  def __init__(self):
+    self.poms = {}
+    self.lock = threading.Lock()
+
+  def Get(self, downloader, arti):
+    key = '%s/%s' % (arti.Path(), arti.GetPom())
+    with self.lock:
+      pom = self.poms.get(key)
+    if pom is None:
+      pom = Pom.Parse(downloader, arti)
+      with self.lock:
+        pom = self.poms.setdefault(key, pom)
+    return pom
+
+
+class Resolver(object):
+  '''
+    Resolves the classpaths of several scopes in one walk of the dependency
+    graph, each pom is fetched and parsed once. Versions are mediated for each
+    scope over the artifacts of its classpath only (see Pom.Slim), so every
+    classpath is the same as if its scope were resolved alone.
+
+    Dependencies matching |excludes| (group[:artifact] patterns, see
+    DEFAULT_EXCLUDES) or the <exclusions> of any dependency on the way to them
+    are skipped before their poms are fetched.
+  '''
+  def __init__(self, downloader, scopes=('compile',), listener=None,
+               excludes=None):
+    self.downloader = downloader
+    self.scopes = list(scopes)
+    self.listener = listener
+    # scopes worth walking, the others do not reach any requested classpath.
+    self.wanted = set(s for scope in self.scopes
+                      for s in CLASSPATH_SCOPES[scope])
+    if excludes is None:
+      excludes = DEFAULT_EXCLUDES
+    self.excludes = frozenset(ParseExclude(e) for e in excludes)
+    # declared scopes any walk may accept, see _Propagate().
+    self.declared = self.wanted.union(
+        k for table in TRANSITIVE_SCOPES.itervalues()
+        for k, s in table.iteritems() if s in self.wanted)
+    # (artifact as parsed, dependencies) by node, the poms are not kept.
+    self.nodes = {}
+
+  @staticmethod
+  def _Node(arti):
+    # the extension is only known once the pom is parsed.
+    return (arti.group_id, arti.artifact_id, arti.classifier, arti.version)
+
+  def AddPom(self, pom):
+    if self.listener:
+      self.listener(pom.this_artifact)
+    entry = (pom.this_artifact, pom.GetDependencies(self.declared,
+                                                    self.excludes))
+    self.nodes[Resolver._Node(pom.this_artifact)] = entry
+    return entry
+
+  def _GetNode(self, arti):
+    entry = self.nodes.get(Resolver._Node(arti))
+    if entry is None:
+      entry = self.AddPom(Pom.Parse(self.downloader, arti))
+    return entry
+
+  def _Propagate(self, scope):
+    if scope is None:
+      # direct dependencies of a root keep their declared scope.
+      table = dict((s, s) for s in SCOPES)
+    else:
+      table = TRANSITIVE_SCOPES[scope]
+    return dict((k, s) for k, s in table.iteritems() if s in self.wanted).get
+
+  def Resolve(self, roots, parent_needs=None):
+    '''Returns the artifacts of every scope keyed by scope, with |roots|
+       keeping their versions.'''
+    skipped = set(Resolver._Node(arti) for arti in parent_needs or [])
+    reached = []
+    # exclusions each (node, scope) was walked with, walking it again with
+    # more of them reaches nothing new.
+    walked = {}
+    # depth first, so the order is the same as walking the tree.
+    stack = [(arti, None, self.excludes) for arti in reversed(roots)]
+    while stack:
+      arti, scope, exclusions = stack.pop()
+      node = Resolver._Node(arti)
+      if node in skipped:
+        continue
+      seen = walked.setdefault((node, scope), [])
+      if any(e.issubset(exclusions) for e in seen):
+        continue
+      seen.append(exclusions)
+      parsed, dependencies = self._GetNode(arti)
+      reached.append((parsed, scope or 'compile'))
+      accept = self._Propagate(scope)
+      children = []
+      for coordinate, declared, own in dependencies:
+        dep_scope = accept(declared)
+        if dep_scope is None or \
+            _IsExcluded(exclusions, coordinate[0], coordinate[1]):
+          continue
+        # versions are resolved only for dependencies not excluded.
+        children.append((_ResolveArtifact(self.downloader, coordinate),
+                         dep_scope, exclusions.union(own)))
+      # resolve snapshot dependencies in one concurrent batch.
+      m.ResolveSnapshots(self.downloader, [dep for dep, _, _ in children])
+      stack.extend(reversed(children))
+
+    # roots as parsed, their poms may tell another extension.
+    roots = [self.nodes[Resolver._Node(arti)][0] for arti in roots
+             if Resolver._Node(arti) in self.nodes]
+    result = {}
+    for scope in self.scopes:
+      classpath = CLASSPATH_SCOPES[scope]
+      result[scope] = Pom.Slim([arti for arti, s in reached if s in classpath],
+                               roots)
+    return result
+
+
 if __name__ == '__main__':
+  # Test exclusions
+  assert ParseExclude('org.mortbay.jetty') == ('org.mortbay.jetty', '*')
+  assert ParseExclude('com.sun.jersey:jersey-*') == ('com.sun.jersey',
+                                                      'jersey-*')
+  excludes = [ParseExclude(e) for e in DEFAULT_EXCLUDES]
+  assert _IsExcluded(excludes, 'javax.servlet', 'servlet-api')
+  assert not _IsExcluded(excludes, 'javaxx', 'servlet-api')
+  assert _IsExcluded([('*', '*')], 'org.slf4j', 'slf4j-api')
+  assert not _IsExcluded([('org.slf4j', 'slf4j-log4j*')], 'org.slf4j',
+                         'slf4j-api')
+
+  # Test the resolver against the repository of test/data.
   import downloader
-  d = downloader.Downloader(base='http://repo1.maven.org/maven2/')
+  import file_fetcher
+  import os
+  repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test',
+                      'data', 'repo')
+  d = downloader.Downloader(file_fetcher.FileFetcher(),
+                            base=os.path.abspath(repo) + '/')
+
+  def Resolve(scopes, coordinate):
+    result = Resolver(d, scopes).Resolve([a.Artifact.Parse(coordinate)])
+    return dict((scope, ['%s:%s' % (arti.artifact_id, arti.version)
+                         for arti in artifacts])
+                for scope, artifacts in result.iteritems())
+
+  # compile -> runtime -> runtime, transitive provided and test dependencies
+  # are dropped without fetching their poms (lib and rt have them, there are
+  # none in the repository).
+  result = Resolve(['compile', 'runtime', 'test'], 'pymvn.test:app:1.0')
+  assert result['compile'] == ['app:1.0', 'lib:1.0'], result
+  assert result['runtime'] == ['app:1.0', 'lib:1.0', 'librt:1.0', 'rt:1.0',
+                               'rtlib:1.0'], result
+  assert result['test'] == ['app:1.0', 'lib:1.0', 'librt:1.0', 'rt:1.0',
+                            'rtlib:1.0', 'prov:1.0', 'tst:1.0'], result
+  assert Resolve(['provided'], 'pymvn.test:app:1.0') == {
+      'provided': ['app:1.0', 'lib:1.0', 'prov:1.0'] }
+
+  # each scope is mediated alone, c 2.0 only comes with the test dependency b.
+  result = Resolve(['compile', 'test'], 'pymvn.test:s:1.0')
+  assert result['compile'] == ['s:1.0', 'c:1.0'], result
+  assert result['test'] == ['s:1.0', 'c:2.0', 'b:1.0'], result
+  assert Resolve(['compile'], 'pymvn.test:s:1.0') == {
+      'compile': result['compile'] }
+  # while the highest version wins within a scope.
+  assert Resolve(['compile'], 'pymvn.test:pl:1.0') == {
+      'compile': ['pl:1.0', 'c:2.0', 'b:1.0'] }
+
+  # own managed versions win over inherited ones, which win over imported
+  # ones, c is managed with a property of the parent.
+  d.pom_cache = PomCache()
+  child = Pom.Parse(d, a.Artifact.Parse('pymvn.test:child:3.0'))
+  assert child.GetManagedVersions() == {
+      ('pymvn.test', 'c'): '1.0', ('pymvn.test', 'e'): '2.0',
+      ('pymvn.test', 'f'): '1.0' }, child.GetManagedVersions()
+  # ${project.version} of g is the version of child, and the version-less
+  # org.gone:gone of h, which has no metadata.xml, is excluded by child.
+  assert Resolve(['compile'], 'pymvn.test:child:3.0') == {
+      'compile': ['child:3.0', 'c:1.0', 'e:2.0', 'f:1.0', 'g:3.0', 'h:1.0'] }
+  # only the parent and the bom are kept.
+  assert sorted(d.pom_cache.poms) == [
+      'pymvn/test/bom/1.0/bom-1.0.pom', 'pymvn/test/parent/1.0/parent-1.0.pom']
+
+  print 'Pass'
+
+  # Tests below need the network.
+  import http_fetcher
+  d = downloader.Downloader(http_fetcher.HttpFetcher(),
+                            base='http://repo1.maven.org/maven2/')
 
   # Test1
   coordinate1 = 'org.powermock:powermock-core:1.5.5'
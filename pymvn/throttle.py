@@ -0,0 +1,199 @@
+# Adaptive concurrency and rate limiting of requests.
+
+
+import calendar
+import email.utils
+import threading
+import time
+
+
+DEFAULT_MAX_CONNECTIONS = 16
+# Longest Retry-After we are willing to honor.
+MAX_RETRY_AFTER = 300.0
+
+
+def ParseRetryAfter(value, now=None):
+  '''Seconds to wait according a Retry-After header, which is either a
+     number of seconds or a HTTP date.'''
+  if not value:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    seconds = float(value)
+  else:
+    parsed = email.utils.parsedate_tz(value)
+    if not parsed:
+      return None
+    if parsed[9] is None:
+      timestamp = calendar.timegm(parsed[:9])
+    else:
+      timestamp = email.utils.mktime_tz(parsed)
+    seconds = timestamp - (now if now is not None else time.time())
+  return max(0.0, min(seconds, MAX_RETRY_AFTER))
+
+
+class HostController(object):
+  '''
+    Limits concurrent requests to one host. The limit grows additively while
+    responses are fast and healthy, and is cut multiplicatively when the host
+    answers 429/503 or responds much slower than usual. A 429/503 also pauses
+    the host entirely, for its Retry-After or else for |backoff| seconds
+    doubled on every further throttled response in a row.
+  '''
+  def __init__(self, max_limit=DEFAULT_MAX_CONNECTIONS, initial_limit=2,
+               slow_factor=3.0, backoff=0.5):
+    self.max_limit = max(1, max_limit)
+    self.limit = float(min(initial_limit, self.max_limit))
+    self.slow_factor = slow_factor
+    self.active = 0
+    self.latency = None
+    self.paused_until = 0.0
+    self.backoff = backoff
+    self.throttled = 0
+    self.cond = threading.Condition()
+
+  def Acquire(self):
+    with self.cond:
+      while True:
+        wait = self.paused_until - time.time()
+        if wait <= 0 and self.active < int(self.limit):
+          break
+        self.cond.wait(wait if wait > 0 else None)
+      self.active += 1
+
+  def Release(self):
+    with self.cond:
+      self.active -= 1
+      self.cond.notify_all()
+
+  def OnResponse(self, latency):
+    with self.cond:
+      self.throttled = 0
+      if self.latency is not None and \
+          latency > self.latency * self.slow_factor:
+        self._Decrease()
+      else:
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+      # exponentially weighted moving average of latency.
+      if self.latency is None:
+        self.latency = latency
+      else:
+        self.latency = 0.8 * self.latency + 0.2 * latency
+      self.cond.notify_all()
+
+  def OnThrottled(self, retry_after=None):
+    '''A retry_after of None means the server gave no hint, 0 only lowers
+       the limit.'''
+    with self.cond:
+      self._Decrease()
+      self.throttled += 1
+      if retry_after is None:
+        retry_after = min(MAX_RETRY_AFTER,
+                          self.backoff * (2 ** (self.throttled - 1)))
+      if retry_after:
+        self.paused_until = max(self.paused_until, time.time() + retry_after)
+      self.cond.notify_all()
+
+  def _Decrease(self):
+    self.limit = max(1.0, self.limit / 2)
+
+
+class RateLimiter(object):
+  '''Token bucket capping the transfer to |rate| bytes per second.'''
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.tokens = self.rate
+    self.updated = time.time()
+    self.lock = threading.Lock()
+
+  def Consume(self, size):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.rate,
+                        self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= size
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+    if wait > 0:
+      time.sleep(wait)
+
+
+class Throttle(object):
+  '''Per host controllers plus an optional overall bytes per second cap.'''
+  def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, max_rate=None):
+    self.max_connections = max_connections
+    self.rate_limiter = RateLimiter(max_rate) if max_rate else None
+    self.hosts = {}
+    self.lock = threading.Lock()
+
+  def Host(self, host):
+    with self.lock:
+      controller = self.hosts.get(host)
+      if controller is None:
+        controller = HostController(self.max_connections)
+        self.hosts[host] = controller
+      return controller
+
+
+class ThrottledResponse(object):
+  '''Wraps a response so that its connection slot is held until the body is
+     consumed, and reads are paced by the rate limiter.'''
+  def __init__(self, response, controller, rate_limiter=None):
+    self.response = response
+    self.controller = controller
+    self.rate_limiter = rate_limiter
+    self.released = False
+
+  def read(self, size=-1):
+    data = self.response.read() if size < 0 else self.response.read(size)
+    if self.rate_limiter and data:
+      self.rate_limiter.Consume(len(data))
+    if size < 0 or not data:
+      self._Release()
+    return data
+
+  def close(self):
+    self._Release()
+    self.response.close()
+
+  def _Release(self):
+    if not self.released:
+      self.released = True
+      self.controller.Release()
+
+  def __getattr__(self, name):
+    return getattr(self.response, name)
+
+  def __del__(self):
+    self._Release()
+
+
+if __name__ == '__main__':
+  # Test Retry-After
+  assert ParseRetryAfter('120') == 120.0
+  assert ParseRetryAfter('100000') == MAX_RETRY_AFTER
+  assert ParseRetryAfter('Thu, 01 Jan 1970 00:01:00 GMT', now=0) == 60.0
+  assert ParseRetryAfter('garbage') is None
+
+  # Test controller
+  c = HostController(max_limit=4, initial_limit=2)
+  for _ in range(20):
+    c.OnResponse(0.1)
+  assert int(c.limit) == 4
+  c.OnThrottled()
+  assert int(c.limit) == 2
+  assert c.paused_until > time.time()
+  c.OnResponse(10.0)
+  assert int(c.limit) == 1
+
+  # Test backoff without Retry-After
+  c = HostController(backoff=10)
+  now = time.time()
+  c.OnThrottled()
+  assert now + 10 <= c.paused_until < now + 11
+  c.OnThrottled()
+  assert now + 20 <= c.paused_until < now + 21
+  c.OnThrottled(0)
+  assert c.paused_until < now + 21
+
+  print 'Pass'
@@ -2,18 +2,32 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import collections
 import contextlib
+import errno
 import fnmatch
 import hashlib
 import json
+import mmap
+import multiprocessing
 import os
 import re
 import pipes
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 
 @contextlib.contextmanager
@@ -32,6 +46,172 @@ def CopyFile(src, dst):
     shutil.copy(src, dst)
 
 
+def _LoadKernelCopy():
+  '''copy_file_range() and sendfile() of libc, which copy between files
+     inside the kernel. Only Linux supports sendfile() to a regular file.'''
+  if not sys.platform.startswith('linux'):
+    return None, None
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  except (ImportError, OSError):
+    return None, None
+  copy_file_range = getattr(libc, 'copy_file_range', None)
+  if copy_file_range:
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                ctypes.c_int, ctypes.c_void_p,
+                                ctypes.c_size_t, ctypes.c_uint]
+    copy_file_range.restype = ctypes.c_ssize_t
+  sendfile = getattr(libc, 'sendfile', None)
+  if sendfile:
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+  return copy_file_range, sendfile
+
+
+_COPY_FILE_RANGE, _SENDFILE = _LoadKernelCopy()
+# Bytes handed to the kernel per call.
+_KERNEL_COPY_CHUNK = 1 << 30
+
+
+def _KernelCopy(copy, src_fd, dst_fd, size):
+  '''Copy |size| bytes with |copy|, returns False when it is unsupported
+     for these files before anything was copied.'''
+  import ctypes
+  copied = 0
+  while copied < size:
+    n = copy(src_fd, dst_fd, min(size - copied, _KERNEL_COPY_CHUNK))
+    if n < 0:
+      err = ctypes.get_errno()
+      if err == errno.EINTR:
+        continue
+      if copied == 0 and err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                 errno.EOPNOTSUPP, errno.EBADF):
+        return False
+      raise OSError(err, os.strerror(err))
+    if n == 0:
+      break
+    copied += n
+  return True
+
+
+def CopyFileFast(src, dst):
+  '''Copy |src| to |dst| inside the kernel when possible, falling back to a
+     plain copy.'''
+  with open(src, 'rb') as fsrc:
+    size = os.fstat(fsrc.fileno()).st_size
+    with open(dst, 'wb') as fdst:
+      if size:
+        if _COPY_FILE_RANGE and _KernelCopy(
+            lambda i, o, n: _COPY_FILE_RANGE(i, None, o, None, n, 0),
+            fsrc.fileno(), fdst.fileno(), size):
+          return
+        if _SENDFILE and _KernelCopy(
+            lambda i, o, n: _SENDFILE(o, i, None, n),
+            fsrc.fileno(), fdst.fileno(), size):
+          return
+      shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def LinkOrCopy(src, dst):
+  '''Hardlink |src| to |dst|, or copy it when they are on different devices.'''
+  if os.path.exists(dst):
+    if os.path.samefile(src, dst):
+      return
+    os.remove(dst)
+  try:
+    os.link(src, dst)
+  except (OSError, AttributeError):
+    CopyFileFast(src, dst)
+
+
+def _IsProcessAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+class FileLock(object):
+  '''Exclusive lock on |path| between processes (and threads).
+
+     flock() is used where available, the kernel drops it when the holder
+     dies. Otherwise |path| is created exclusively with the owner pid in it,
+     and taken over once that process is gone or the file is older than
+     |stale_after| seconds.'''
+  def __init__(self, path, stale_after=3600, poll_interval=0.1):
+    self.path = path
+    self.stale_after = stale_after
+    self.poll_interval = poll_interval
+    self.fd = None
+
+  def __enter__(self):
+    self.Acquire()
+    return self
+
+  def Acquire(self, blocking=True):
+    '''Returns whether the lock is taken, which is always the case when
+       |blocking|.'''
+    MakeDirectory(os.path.dirname(self.path))
+    if fcntl:
+      self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+      try:
+        fcntl.flock(self.fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+      except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          raise
+        os.close(self.fd)
+        self.fd = None
+        return False
+      return True
+    while True:
+      try:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0666)
+        os.write(self.fd, str(os.getpid()))
+        return True
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+      if self._IsStale():
+        try:
+          os.remove(self.path)
+        except OSError:
+          pass
+        continue
+      if not blocking:
+        return False
+      time.sleep(self.poll_interval)
+
+  def _IsStale(self):
+    try:
+      with open(self.path, 'r') as f:
+        pid = f.read().strip()
+      age = time.time() - os.path.getmtime(self.path)
+    except (IOError, OSError):
+      # released meanwhile.
+      return False
+    if age > self.stale_after:
+      return True
+    # an empty file is a lock being written, give it a moment.
+    return pid.isdigit() and not _IsProcessAlive(int(pid))
+
+  def __exit__(self, *args):
+    self.Release()
+
+  def Release(self):
+    if fcntl:
+      # the lock file stays, removing it would race with waiters.
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+      os.close(self.fd)
+    else:
+      os.close(self.fd)
+      os.remove(self.path)
+    self.fd = None
+
+
 def MakeDirectory(dir_path):
   try:
     os.makedirs(dir_path)
@@ -87,6 +267,37 @@ def WriteJson(obj, path, only_if_changed=False):
       outfile.write(new_dump)
 
 
+def TempPath(path):
+  '''A path next to |path| unique to this process and thread.'''
+  return '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+
+def WriteFileAtomic(path, content):
+  '''Write |content| aside and rename it over |path|, so that concurrent
+     writers and readers never see a partial file.'''
+  tmp_path = TempPath(path)
+  try:
+    with open(tmp_path, 'wb') as f:
+      f.write(content)
+    os.rename(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+
+def WriteDepfile(path, target, deps):
+  '''Write a make style depfile, leaving it untouched when unchanged.'''
+  escape = lambda p: p.replace(' ', '\\ ')
+  content = '%s: %s\n' % (escape(target), ' '.join(escape(d) for d in deps))
+  if os.path.exists(path):
+    with open(path, 'r') as f:
+      if f.read() == content:
+        return
+  MakeDirectory(os.path.dirname(path))
+  with open(path, 'w') as f:
+    f.write(content)
+
+
 def ReadJson(path):
   with open(path, 'r') as jsonfile:
     return json.load(jsonfile)
@@ -175,7 +386,35 @@ def CheckZipPath(name):
     raise Exception('Absolute zip path: %s' % name)
 
 
-def ExtractAll(zip_path, path=None, no_clobber=True, pattern=None):
+def _FileCRC(path):
+  crc = 0
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), ''):
+      crc = zlib.crc32(chunk, crc)
+  return crc & 0xffffffff
+
+
+def _IsExtracted(info, output_path):
+  return os.path.isfile(output_path) \
+      and os.path.getsize(output_path) == info.file_size \
+      and _FileCRC(output_path) == info.CRC
+
+
+def _ExtractEntries(zip_path, infos, path, incremental):
+  # each worker reads through its own ZipFile.
+  with zipfile.ZipFile(zip_path) as z:
+    for info in infos:
+      if incremental and _IsExtracted(info, os.path.join(path, info.filename)):
+        continue
+      z.extract(info, path)
+
+
+def ExtractAll(zip_path, path=None, no_clobber=True, pattern=None,
+               incremental=False, jobs=1):
+  '''Extract |zip_path| into |path|. With |incremental| entries whose size
+     and CRC match what is already on disk are kept as is, and |no_clobber|
+     is not checked since updating existing files is the point. |jobs| > 1
+     spreads the entries over that many workers.'''
   if path is None:
     path = os.getcwd()
   elif not os.path.exists(path):
@@ -189,31 +428,238 @@ def ExtractAll(zip_path, path=None, no_clobber=True, pattern=None):
         if not fnmatch.fnmatch(name, pattern):
           continue
       CheckZipPath(name)
-      if no_clobber:
+      if no_clobber and not incremental:
         output_path = os.path.join(path, name)
         if os.path.exists(output_path):
           raise Exception(
               'Path already exists from zip: %s %s %s'
               % (zip_path, name, output_path))
 
-    z.extractall(path=path)
+    if not incremental and jobs <= 1:
+      z.extractall(path=path)
+      return
+
+    infos = []
+    for info in z.infolist():
+      CheckZipPath(info.filename.rstrip('/'))
+      if info.filename.endswith('/'):
+        MakeDirectory(os.path.join(path, info.filename))
+      else:
+        MakeDirectory(os.path.dirname(os.path.join(path, info.filename)))
+        infos.append(info)
+
+  if jobs <= 1:
+    _ExtractEntries(zip_path, infos, path, incremental)
+    return
+  # balance the workers by uncompressed size.
+  buckets = [[] for _ in xrange(jobs)]
+  for i, info in enumerate(sorted(infos, key=lambda i: -i.file_size)):
+    buckets[i % jobs].append(info)
+  pool = ThreadPool(jobs)
+  try:
+    pool.map(lambda b: _ExtractEntries(zip_path, b, path, incremental),
+             [b for b in buckets if b])
+  finally:
+    pool.close()
+    pool.join()
 
 
-def DoZip(inputs, output, base_dir):
-  with zipfile.ZipFile(output, 'w') as outfile:
-    for f in inputs:
-      CheckZipPath(os.path.relpath(f, base_dir))
-      outfile.write(f, os.path.relpath(f, base_dir))
+# Timestamp of entries written by deterministic zips, the earliest one a zip
+# can hold.
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
 
-def ZipDir(output, base_dir):
-  with zipfile.ZipFile(output, 'w') as outfile:
-    for root, _, files in os.walk(base_dir):
-      for f in files:
-        path = os.path.join(root, f)
-        archive_path = os.path.relpath(path, base_dir)
-        CheckZipPath(archive_path)
+def _PackZipEntry(entry, compress_type, deterministic):
+  path, archive_path = entry
+  st = os.stat(path)
+  if deterministic:
+    zinfo = zipfile.ZipInfo(archive_path, DETERMINISTIC_DATE_TIME)
+    mode = 0755 if st.st_mode & 0111 else 0644
+    zinfo.external_attr = (0100000 | mode) << 16
+  else:
+    zinfo = zipfile.ZipInfo(archive_path,
+                            time.localtime(st.st_mtime)[:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+  zinfo.compress_type = compress_type
+  with open(path, 'rb') as f:
+    data = f.read()
+  zinfo.file_size = len(data)
+  zinfo.CRC = zlib.crc32(data) & 0xffffffff
+  if compress_type == zipfile.ZIP_DEFLATED:
+    # same stream as ZipFile.writestr() produces.
+    co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = co.compress(data) + co.flush()
+  zinfo.compress_size = len(data)
+  return zinfo, data
+
+
+def _WritePackedZipEntry(outfile, zinfo, data):
+  # ZipFile.writestr() without compressing, as |data| already is.
+  zinfo.header_offset = outfile.fp.tell()
+  outfile._writecheck(zinfo)
+  outfile._didModify = True
+  zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+      zinfo.compress_size > zipfile.ZIP64_LIMIT
+  outfile.fp.write(zinfo.FileHeader(zip64))
+  outfile.fp.write(data)
+  outfile.filelist.append(zinfo)
+  outfile.NameToInfo[zinfo.filename] = zinfo
+
+
+def _DoZipEntries(entries, output, deterministic, jobs, compress):
+  compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+  for _, archive_path in entries:
+    CheckZipPath(archive_path)
+  with zipfile.ZipFile(output, 'w', compress_type) as outfile:
+    if not deterministic and jobs <= 1:
+      for path, archive_path in entries:
         outfile.write(path, archive_path)
+      return
+
+    if deterministic:
+      entries = sorted(entries, key=lambda e: e[1])
+    pack = lambda e: _PackZipEntry(e, compress_type, deterministic)
+    if jobs <= 1:
+      for zinfo, data in (pack(e) for e in entries):
+        _WritePackedZipEntry(outfile, zinfo, data)
+      return
+    # compress in parallel, write in order. Only a few entries per job are
+    # read ahead of the writer, so memory stays bound by the largest files.
+    pool = ThreadPool(jobs)
+    pending = collections.deque()
+    try:
+      for e in entries:
+        if len(pending) >= jobs * 2:
+          _WritePackedZipEntry(outfile, *pending.popleft().get())
+        pending.append(pool.apply_async(pack, (e,)))
+      while pending:
+        _WritePackedZipEntry(outfile, *pending.popleft().get())
+    finally:
+      pool.close()
+      pool.join()
+
+
+def DoZip(inputs, output, base_dir, deterministic=False, jobs=1,
+          compress=False):
+  '''Zip |inputs| relative to |base_dir|. |deterministic| sorts entries and
+     pins their timestamps and permissions so the same inputs always give
+     the same bytes, |jobs| > 1 reads and compresses entries in parallel.'''
+  entries = [(f, os.path.relpath(f, base_dir)) for f in inputs]
+  _DoZipEntries(entries, output, deterministic, jobs, compress)
+
+
+def ZipDir(output, base_dir, deterministic=False, jobs=1, compress=False):
+  entries = []
+  for root, _, files in os.walk(base_dir):
+    for f in files:
+      path = os.path.join(root, f)
+      entries.append((path, os.path.relpath(path, base_dir)))
+  _DoZipEntries(entries, output, deterministic, jobs, compress)
+
+
+_EOCD_SIGNATURE = 'PK\x05\x06'
+_EOCD_FORMAT = '<4s4H2LH'
+_EOCD_SIZE = struct.calcsize(_EOCD_FORMAT)
+_CD_SIGNATURE = 'PK\x01\x02'
+_CD_FORMAT = '<4s6H3L5H2L'
+_CD_SIZE = struct.calcsize(_CD_FORMAT)
+
+
+def ReadZipCentralDirectory(zip_path):
+  '''Return names of entries of |zip_path| reading only its central
+     directory, nothing gets decompressed.'''
+  with open(zip_path, 'rb') as f:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    tail_size = min(size, _EOCD_SIZE + 0xFFFF)
+    f.seek(size - tail_size)
+    tail = f.read(tail_size)
+    pos = tail.rfind(_EOCD_SIGNATURE)
+    if pos < 0 or len(tail) - pos < _EOCD_SIZE:
+      raise zipfile.BadZipfile('File is not a zip file: %s' % zip_path)
+    (_, _, _, _, entries, cd_size, cd_offset, _) = struct.unpack(
+        _EOCD_FORMAT, tail[pos:pos + _EOCD_SIZE])
+    if entries == 0xFFFF or cd_offset == 0xFFFFFFFF:
+      # zip64, let zipfile deal with it.
+      with zipfile.ZipFile(zip_path) as z:
+        return z.namelist()
+    # the central directory ends right before the EOCD record, this also
+    # copes with data prepended to the zip.
+    f.seek(size - tail_size + pos - cd_size)
+    cd = f.read(cd_size)
+
+  names = []
+  offset = 0
+  while offset + _CD_SIZE <= len(cd) and \
+      cd[offset:offset + 4] == _CD_SIGNATURE:
+    fields = struct.unpack(_CD_FORMAT, cd[offset:offset + _CD_SIZE])
+    name_length, extra_length, comment_length = fields[10:13]
+    start = offset + _CD_SIZE
+    names.append(cd[start:start + name_length])
+    offset = start + name_length + extra_length + comment_length
+  return names
+
+
+def _IsClassEntry(name):
+  # module-info and multi-release classes are duplicated on purpose.
+  return name.endswith('.class') and not name.startswith('META-INF/') \
+      and name != 'module-info.class'
+
+
+def _ListJarClasses(args):
+  # Runs in a worker process, so it has to live at module level.
+  jar, cache_dir = args
+  cache_path = None
+  if cache_dir:
+    # keyed by what a stat tells, so that a hit never opens the jar.
+    try:
+      st = os.stat(jar)
+    except OSError:
+      return jar, []
+    key = '%s:%d:%r' % (os.path.abspath(jar), st.st_size, st.st_mtime)
+    cache_path = os.path.join(cache_dir, 'classes',
+                              hashlib.md5(key).hexdigest() + '.json')
+    if os.path.exists(cache_path):
+      try:
+        return jar, ReadJson(cache_path)
+      except ValueError:
+        pass
+  try:
+    names = ReadZipCentralDirectory(jar)
+  except (IOError, zipfile.BadZipfile):
+    return jar, []
+  classes = [n for n in names if _IsClassEntry(n)]
+  if cache_path:
+    MakeDirectory(os.path.dirname(cache_path))
+    WriteFileAtomic(cache_path, json.dumps(classes))
+  return jar, classes
+
+
+def FindDuplicateClasses(jars, cache_dir=None, jobs=None):
+  '''Return { class: [jars] } for every class found in more than one of
+     |jars|. Class lists are cached under |cache_dir| per jar path, size and
+     modification time.'''
+  jars = list(jars)
+  if not jars:
+    return {}
+  jobs = jobs or multiprocessing.cpu_count()
+  args = [(jar, cache_dir) for jar in jars]
+  if jobs <= 1:
+    results = map(_ListJarClasses, args)
+  else:
+    pool = multiprocessing.Pool(min(jobs, len(jars)))
+    try:
+      results = pool.map(_ListJarClasses, args,
+                         max(1, len(jars) // (jobs * 4)))
+    finally:
+      pool.close()
+      pool.join()
+
+  owners = {}
+  for jar, classes in results:
+    for c in classes:
+      owners.setdefault(c, []).append(jar)
+  return dict((c, js) for c, js in owners.iteritems() if len(js) > 1)
 
 
 def PrintWarning(message):
@@ -265,12 +711,108 @@ def ExpandFileArgs(args):
   return new_args
 
 
+def MD5File(filename):
+  md5 = hashlib.md5()
+  with open(filename, 'rb') as f:
+    # mmap can not map an empty file.
+    if os.fstat(f.fileno()).st_size:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        md5.update(data)
+      finally:
+        data.close()
+  return md5.hexdigest()
+
+
 def VerifyMD5(filename, expected_md5):
   if not os.path.exists(filename):
     return False
   else:
-    md5 = hashlib.md5()
-    with open(filename, 'rb') as f:
-      for chunk in iter(lambda: f.read(8192), ''):
-        md5.update(chunk)
-    return md5.hexdigest() == expected_md5
+    return MD5File(filename) == expected_md5
+
+
+if __name__ == '__main__':
+  # Test zipping and extracting.
+  with TempDir() as tmp:
+    src = os.path.join(tmp, 'src')
+    files = { 'a.txt': 'a' * 4096, 'dir/b.class': 'b',
+              'dir/sub/c.bin': os.urandom(4096) }
+    for name, content in files.iteritems():
+      MakeDirectory(os.path.dirname(os.path.join(src, name)))
+      with open(os.path.join(src, name), 'wb') as f:
+        f.write(content)
+
+    def CheckZip(zip_path):
+      with zipfile.ZipFile(zip_path) as z:
+        assert z.testzip() is None
+        assert dict((n, z.read(n)) for n in z.namelist()) == files
+
+    for compress in (False, True):
+      outputs = []
+      for jobs in (1, 4):
+        output = os.path.join(tmp, 'd%d%d.zip' % (compress, jobs))
+        ZipDir(output, src, deterministic=True, jobs=jobs, compress=compress)
+        CheckZip(output)
+        with open(output, 'rb') as f:
+          outputs.append(f.read())
+        # deterministic zips do not depend on the mtime.
+        os.utime(os.path.join(src, 'a.txt'), (1e9, 1e9))
+      assert outputs[0] == outputs[1]
+      output = os.path.join(tmp, 'n%d.zip' % compress)
+      ZipDir(output, src, jobs=4, compress=compress)
+      CheckZip(output)
+
+    # only the changed entry is extracted again.
+    dst = os.path.join(tmp, 'dst')
+    ExtractAll(output, dst, jobs=2)
+    for name in files:
+      os.utime(os.path.join(dst, name), (0, 0))
+    with open(os.path.join(dst, 'dir/b.class'), 'wb') as f:
+      f.write('changed')
+    ExtractAll(output, dst, incremental=True, jobs=2)
+    for name, content in files.iteritems():
+      with open(os.path.join(dst, name), 'rb') as f:
+        assert f.read() == content
+      assert (os.path.getmtime(os.path.join(dst, name)) == 0) == \
+          (name != 'dir/b.class'), name
+
+  # Test locking, with flock() where available and with pid files.
+  with TempDir() as tmp:
+    path = os.path.join(tmp, 'locks', 'a.lock')
+    holder = FileLock(path)
+    holder.Acquire()
+    assert not FileLock(path).Acquire(blocking=False)
+    holder.Release()
+    with FileLock(path) as lock:
+      assert lock.fd is not None
+
+    flock, fcntl = fcntl, None
+    try:
+      path = os.path.join(tmp, 'locks', 'b.lock')
+      holder = FileLock(path)
+      holder.Acquire()
+      assert not FileLock(path).Acquire(blocking=False)
+      holder.Release()
+      assert not os.path.exists(path)
+      # taken over from a dead owner.
+      dead = subprocess.Popen(['true'])
+      dead.wait()
+      with open(path, 'w') as f:
+        f.write(str(dead.pid))
+      lock = FileLock(path)
+      assert lock.Acquire(blocking=False)
+      with open(path) as f:
+        assert f.read() == str(os.getpid())
+      lock.Release()
+      # and from a live owner once |stale_after| is over.
+      with open(path, 'w') as f:
+        f.write(str(os.getpid()))
+      assert not FileLock(path).Acquire(blocking=False)
+      os.utime(path, (time.time() - 60, time.time() - 60))
+      lock = FileLock(path, stale_after=30)
+      assert lock.Acquire(blocking=False)
+      lock.Release()
+    finally:
+      fcntl = flock
+
+  print 'Pass'
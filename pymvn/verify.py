@@ -0,0 +1,98 @@
+# Verify an output directory against the maven server.
+
+
+import multiprocessing
+import os
+import utils
+from multiprocessing.pool import ThreadPool
+
+
+def _HashFile(filename):
+  # Runs in a worker process, so it has to live at module level.
+  return filename, utils.MD5File(filename)
+
+
+class Report(object):
+  def __init__(self):
+    self.mismatched = []
+    self.missing = []
+    self.extra = []
+    # files whose checksum could not be fetched, with the reason.
+    self.unverifiable = []
+
+  def IsClean(self):
+    return not (self.mismatched or self.missing or self.extra or
+                self.unverifiable)
+
+  def Lines(self):
+    lines = []
+    lines.extend('mismatched: %s' % f for f in self.mismatched)
+    lines.extend('missing: %s' % f for f in self.missing)
+    lines.extend('extra: %s' % f for f in self.extra)
+    lines.extend('unverifiable: %s (%s)' % u for u in self.unverifiable)
+    return lines
+
+
+def _ListFiles(output_dir):
+  files = set()
+  for root, dirnames, filenames in os.walk(output_dir):
+    # skip pymvn's own locks and staging dirs.
+    dirnames[:] = [n for n in dirnames if not n.startswith('.pymvn-')]
+    for f in filenames:
+      files.add(os.path.join(root, f))
+  return files
+
+
+def Verify(d, output_dir, artifacts, optional_artifacts=None,
+           detailed=False, jobs=8, processes=None):
+  '''Compare |output_dir| with |artifacts| as they would be downloaded by |d|.
+     Files of |optional_artifacts| (e.g. sources jars) are checked when they
+     exist, but not reported when missing.'''
+  expected = {}
+  optional = set()
+  for arti in artifacts:
+    expected[arti.GetFilename(filepath=output_dir, detailed=detailed)] = arti
+  for arti in optional_artifacts or []:
+    filename = arti.GetFilename(filepath=output_dir, detailed=detailed)
+    if filename not in expected:
+      expected[filename] = arti
+      optional.add(filename)
+
+  report = Report()
+  present = _ListFiles(output_dir) if os.path.isdir(output_dir) else set()
+  report.extra = sorted(present.difference(expected))
+  report.missing = sorted(f for f in expected
+                          if f not in present and f not in optional)
+  pending = sorted(f for f in expected if f in present)
+  if not pending:
+    return report
+
+  def _FetchChecksum(filename):
+    arti = expected[filename]
+    url = '%s/%s' % (d.base, arti.Path(with_filename=True))
+    # one missing checksum must not end the whole audit.
+    try:
+      return filename, d.GetMD5(url), None
+    except Exception as e:
+      return filename, None, str(e)
+
+  # remote checksums are bound by network, local ones by cpu and disk,
+  # so run both at the same time.
+  processes = processes or multiprocessing.cpu_count()
+  threads = ThreadPool(max(1, min(jobs, len(pending))))
+  workers = multiprocessing.Pool(processes)
+  try:
+    remote = threads.map_async(_FetchChecksum, pending)
+    chunksize = max(1, len(pending) // (processes * 4))
+    local = dict(workers.imap_unordered(_HashFile, pending, chunksize))
+    for filename, md5, error in remote.get():
+      if error is not None:
+        report.unverifiable.append((filename, error))
+      elif local[filename] != md5:
+        report.mismatched.append(filename)
+  finally:
+    threads.close()
+    workers.close()
+    threads.join()
+    workers.join()
+  return report
@@ -0,0 +1,199 @@
+# Maven version ordering and version ranges defined by:
+#   https://maven.apache.org/pom.html#Dependency_Version_Requirement_Specification
+
+
+import bisect
+import re
+
+
+# Known qualifiers in ascending order, anything else sorts after 'sp'.
+QUALIFIERS = [ 'alpha', 'beta', 'milestone', 'rc', 'snapshot', '', 'sp' ]
+QUALIFIER_ALIASES = {
+    'a': 'alpha',
+    'b': 'beta',
+    'm': 'milestone',
+    'cr': 'rc',
+    'ga': '',
+    'final': '',
+    'release': '',
+}
+
+_TOKEN_RE = re.compile(r'\d+|[a-z]+')
+_RELEASE = (1, QUALIFIERS.index(''), '')
+
+
+def _Item(token):
+  if token.isdigit():
+    return (2, int(token), '')
+  token = QUALIFIER_ALIASES.get(token, token)
+  if token in QUALIFIERS:
+    return (1, QUALIFIERS.index(token), '')
+  return (1, len(QUALIFIERS), token)
+
+
+def Key(version):
+  '''Sort key of |version| following (a simplified) Maven ComparableVersion:
+     numbers compare numerically, qualifiers follow QUALIFIERS, and trailing
+     zeros or release qualifiers do not matter, so 1 == 1.0 == 1.0-ga.'''
+  items = []
+  for token in _TOKEN_RE.findall(version.lower()):
+    item = _Item(token)
+    if item == _RELEASE:
+      continue
+    if item[0] == 1:
+      # 1.0-alpha is the same as 1-alpha
+      while items and items[-1] == (2, 0, ''):
+        items.pop()
+    items.append(item)
+  while items and items[-1] == (2, 0, ''):
+    items.pop()
+  # terminate with the release item, so that a shorter version compares
+  # against the rest of a longer one as Maven pads with null items.
+  items.append(_RELEASE)
+  return tuple(items)
+
+
+def Compare(v1, v2):
+  return cmp(Key(v1), Key(v2))
+
+
+def IsSnapshot(version):
+  return version.endswith('SNAPSHOT')
+
+
+def IsRange(spec):
+  return bool(spec) and spec[0] in '[('
+
+
+class Restriction(object):
+  def __init__(self, lower, lower_inclusive, upper, upper_inclusive):
+    self.lower = Key(lower) if lower else None
+    self.lower_inclusive = lower_inclusive
+    self.upper = Key(upper) if upper else None
+    self.upper_inclusive = upper_inclusive
+
+  def Contains(self, key):
+    if self.lower is not None:
+      if key < self.lower or (key == self.lower and not self.lower_inclusive):
+        return False
+    if self.upper is not None:
+      if key > self.upper or (key == self.upper and not self.upper_inclusive):
+        return False
+    return True
+
+
+class VersionRange(object):
+  '''
+    The possible options are:
+    - [1.0]: exactly 1.0
+    - [1.0,2.0), (1.0,2.0], [1.0,), (,1.0]: bounded or half-bounded
+    - (,1.0],[1.2,): union of several ranges
+  '''
+  def __init__(self, spec):
+    self.spec = spec
+    self.restrictions = []
+    rest = spec.replace(' ', '')
+    while rest:
+      if rest[0] not in '[(':
+        raise ValueError('Invalid version range %s' % spec)
+      end = min([i for i in (rest.find(']'), rest.find(')')) if i >= 0] or
+                [-1])
+      if end < 0:
+        raise ValueError('Invalid version range %s' % spec)
+      self.restrictions.append(self._ParseRestriction(rest[:end + 1]))
+      rest = rest[end + 1:]
+      if rest.startswith(','):
+        rest = rest[1:]
+
+  def _ParseRestriction(self, text):
+    lower_inclusive = text[0] == '['
+    upper_inclusive = text[-1] == ']'
+    body = text[1:-1]
+    if ',' not in body:
+      if not (lower_inclusive and upper_inclusive) or not body:
+        raise ValueError('Invalid version range %s' % self.spec)
+      return Restriction(body, True, body, True)
+    lower, upper = body.split(',', 1)
+    if ',' in upper:
+      raise ValueError('Invalid version range %s' % self.spec)
+    return Restriction(lower, lower_inclusive, upper, upper_inclusive)
+
+  def Contains(self, version):
+    key = Key(version)
+    return any(r.Contains(key) for r in self.restrictions)
+
+
+class VersionIndex(object):
+  '''Versions of one artifact sorted by Maven ordering.'''
+  def __init__(self, versions):
+    self.versions = sorted(set(versions), key=Key)
+    self.keys = [Key(v) for v in self.versions]
+
+  def Latest(self, include_snapshots=False):
+    for v in reversed(self.versions):
+      if include_snapshots or not IsSnapshot(v):
+        return v
+    return self.versions[-1] if self.versions else None
+
+  def _Highest(self, restriction):
+    if restriction.upper is None:
+      end = len(self.keys)
+    elif restriction.upper_inclusive:
+      end = bisect.bisect_right(self.keys, restriction.upper)
+    else:
+      end = bisect.bisect_left(self.keys, restriction.upper)
+    if restriction.lower is None:
+      begin = 0
+    elif restriction.lower_inclusive:
+      begin = bisect.bisect_left(self.keys, restriction.lower)
+    else:
+      begin = bisect.bisect_right(self.keys, restriction.lower)
+    # prefer releases, as Maven does not pick snapshots for ranges either.
+    for i in xrange(end - 1, begin - 1, -1):
+      if not IsSnapshot(self.versions[i]):
+        return i
+    return None
+
+  def Resolve(self, spec):
+    '''Highest version matching the range |spec|, or None.'''
+    best = None
+    for restriction in VersionRange(spec).restrictions:
+      i = self._Highest(restriction)
+      if i is not None and (best is None or i > best):
+        best = i
+    return self.versions[best] if best is not None else None
+
+
+if __name__ == '__main__':
+  # Test ordering
+  assert Compare('1', '1.0') == 0
+  assert Compare('1.0', '1.0.0-ga') == 0
+  assert Compare('1.0-alpha', '1.0') < 0
+  assert Compare('1.0-alpha', '1.0-beta') < 0
+  assert Compare('1.0-rc1', '1.0-SNAPSHOT') < 0
+  assert Compare('1.0-SNAPSHOT', '1.0') < 0
+  assert Compare('1.0', '1.0-sp1') < 0
+  assert Compare('1.0', '1.0.1') < 0
+  assert Compare('1.9', '1.10') < 0
+  assert Compare('2.0', '10.0') < 0
+
+  # Test range
+  assert IsRange('[1.0,2.0)')
+  assert not IsRange('1.0')
+  assert VersionRange('[1.0,2.0)').Contains('1.5')
+  assert not VersionRange('[1.0,2.0)').Contains('2.0')
+  assert VersionRange('(,1.0],[1.2,)').Contains('1.3')
+  assert not VersionRange('(,1.0],[1.2,)').Contains('1.1')
+  assert VersionRange('[1.0]').Contains('1.0')
+
+  # Test index
+  index = VersionIndex(['1.10', '1.9', '2.0-SNAPSHOT', '2.0', '1.0'])
+  assert index.versions == ['1.0', '1.9', '1.10', '2.0-SNAPSHOT', '2.0']
+  assert index.Latest() == '2.0'
+  assert index.Resolve('[1.0,2.0)') == '1.10'
+  assert index.Resolve('[1.0,1.9]') == '1.9'
+  assert index.Resolve('(1.0,1.9)') is None
+  assert index.Resolve('[2.0,)') == '2.0'
+  assert index.Resolve('(,1.0],[1.9]') == '1.9'
+
+  print 'Pass'